@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Маршрутизация нажатий inline-кнопок по callback_data
+
+Маршрут - шаблон callback_data и обработчик:
+- "catalog" - точное совпадение (поиск в словаре)
+- "orders_page:{direction}:{cursor}" - фиксированный префикс и параметры;
+  префиксы хранятся в префиксном дереве, поэтому поиск маршрута
+  линеен по длине callback_data, а не по числу маршрутов
+
+Параметры разбираются один раз при маршрутизации и передаются
+обработчику именованными аргументами уже нужного типа:
+{amount:float}, {order_id:int}, {name} (строка). Строковый параметр
+может содержать "_", граница определяется остальной частью шаблона.
+
+Кнопки с произвольными данными кодируются компактно: "@<код>:<токен>",
+а сами данные хранятся на сервере (PayloadCache, TTL) - лимит Telegram
+в 64 байта на callback_data не ограничивает их размер, разбор - поиск
+в словаре. Если данные истекли, нажатие считается устаревшим.
+"""
+
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_PAYLOAD_TTL = float(os.getenv('CALLBACK_PAYLOAD_TTL', 3600))
+CALLBACK_PAYLOAD_SIZE = int(os.getenv('CALLBACK_PAYLOAD_SIZE', 50000))
+
+# Префикс callback_data кнопок с данными на сервере
+PAYLOAD_MARKER = '@'
+
+# Тип параметра -> (регулярное выражение, преобразование)
+CONVERTERS = {
+    'str': (r'[^:]+?', str),
+    'int': (r'-?\d+', int),
+    'float': (r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?', float)
+}
+
+_PARAM_RE = re.compile(r'\{(\w+)(?::(\w+))?\}')
+
+
+class Route:
+    def __init__(self, pattern, handler, admin_only=False):
+        self.pattern = pattern
+        self.handler = handler
+        self.admin_only = admin_only
+        self.prefix = pattern.split('{', 1)[0]
+        self.converters = {}
+
+        regex = ''
+        position = len(self.prefix)
+        for match in _PARAM_RE.finditer(pattern, position):
+            regex += re.escape(pattern[position:match.start()])
+            name, kind = match.group(1), match.group(2) or 'str'
+            if kind not in CONVERTERS:
+                raise ValueError(f"Неизвестный тип параметра {kind} в маршруте {pattern}")
+            regex += f'(?P<{name}>{CONVERTERS[kind][0]})'
+            self.converters[name] = CONVERTERS[kind][1]
+            position = match.end()
+        regex += re.escape(pattern[position:])
+        self._regex = re.compile(regex)
+
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def parse(self, data):
+        """Параметры из callback_data или None, если шаблон не подходит"""
+        match = self._regex.fullmatch(data, len(self.prefix))
+        if match is None:
+            return None
+        try:
+            return {name: self.converters[name](value) for name, value in match.groupdict().items()}
+        except ValueError:
+            return None
+
+    def record(self, elapsed, failed):
+        self.calls += 1
+        self.errors += failed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+class PayloadCache:
+    """Данные кнопок на сервере: токен -> (данные, владелец, срок), LRU с TTL"""
+
+    def __init__(self, max_size=CALLBACK_PAYLOAD_SIZE, ttl=CALLBACK_PAYLOAD_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def put(self, payload, user_id=None):
+        """Сохранить данные и вернуть короткий токен"""
+        token = secrets.token_urlsafe(6)
+        with self._lock:
+            self._data[token] = (payload, user_id, time.monotonic() + self.ttl)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return token
+
+    def get(self, token, user_id=None):
+        """Данные по токену или None (истекли, вытеснены или чужая кнопка)"""
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is None:
+                self.expired += 1
+                return None
+            payload, owner, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[token]
+                self.expired += 1
+                return None
+        if owner is not None and owner != user_id:
+            return None
+        return payload
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _TrieNode:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+
+class CallbackRouter:
+    """Таблица маршрутов: точные совпадения + префиксное дерево"""
+
+    def __init__(self, is_admin=None, payloads=None):
+        self.is_admin = is_admin or (lambda user_id: False)
+        self.payloads = payloads if payloads is not None else PayloadCache()
+        self._exact = {}
+        self._root = _TrieNode()
+        # код -> маршрут кнопок с данными на сервере
+        self._payload_routes = {}
+
+    def add(self, pattern, handler, admin_only=False):
+        route = Route(pattern, handler, admin_only)
+        if route.prefix == pattern:
+            if pattern in self._exact:
+                raise ValueError(f"Маршрут {pattern} уже зарегистрирован")
+            self._exact[pattern] = route
+            return route
+
+        node = self._root
+        for char in route.prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        node.routes.append(route)
+        return route
+
+    def route(self, pattern, admin_only=False):
+        """Декоратор: зарегистрировать обработчик handler(query, **параметры)"""
+        def decorator(handler):
+            self.add(pattern, handler, admin_only)
+            return handler
+        return decorator
+
+    def payload_route(self, opcode, admin_only=False):
+        """Декоратор: обработчик handler(query, **данные) для кнопок из pack(opcode, ...)"""
+        if ':' in opcode or opcode in self._payload_routes:
+            raise ValueError(f"Недопустимый или повторный код кнопки: {opcode}")
+
+        def decorator(handler):
+            self._payload_routes[opcode] = Route(f"{PAYLOAD_MARKER}{opcode}", handler, admin_only)
+            return handler
+        return decorator
+
+    def pack(self, opcode, payload, user_id=None):
+        """callback_data для кнопки с данными payload (dict); user_id - только для этого пользователя"""
+        if opcode not in self._payload_routes:
+            raise ValueError(f"Неизвестный код кнопки: {opcode}")
+        return f"{PAYLOAD_MARKER}{opcode}:{self.payloads.put(payload, user_id)}"
+
+    def resolve(self, data, user_id=None):
+        """Найти маршрут: (route, параметры) или (None, None)"""
+        if data.startswith(PAYLOAD_MARKER):
+            opcode, _, token = data[len(PAYLOAD_MARKER):].partition(':')
+            route = self._payload_routes.get(opcode)
+            payload = self.payloads.get(token, user_id) if route else None
+            return (route, dict(payload)) if payload is not None else (None, None)
+
+        route = self._exact.get(data)
+        if route is not None:
+            return route, {}
+
+        # Маршруты всех префиксов callback_data, от самого длинного
+        candidates = []
+        node = self._root
+        for char in data:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.routes:
+                candidates.append(node.routes)
+
+        for routes in reversed(candidates):
+            for route in routes:
+                params = route.parse(data)
+                if params is not None:
+                    return route, params
+        return None, None
+
+    async def dispatch(self, query):
+        """Вызвать обработчик нажатия; False - кнопка устарела, не найдена или нет прав"""
+        route, params = self.resolve(query.data or '', query.from_user.id)
+        if route is None:
+            logger.info(f"Устаревшая или неизвестная кнопка: {query.data}")
+            return False
+        if route.admin_only and not self.is_admin(query.from_user.id):
+            logger.warning(f"Отказ в доступе к {route.pattern} для {query.from_user.id}")
+            return False
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            await route.handler(query, **params)
+            failed = False
+        finally:
+            route.record(time.perf_counter() - started, failed)
+        return True
+
+    def stats(self):
+        """Время обработки по маршрутам (мс)"""
+        routes = list(self._exact.values()) + list(self._payload_routes.values())
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            routes.extend(node.routes)
+            stack.extend(node.children.values())
+
+        return {
+            route.pattern: {
+                'calls': route.calls,
+                'errors': route.errors,
+                'avg_ms': round(route.total_time / route.calls * 1000, 2) if route.calls else 0.0,
+                'max_ms': round(route.max_time * 1000, 2)
+            }
+            for route in routes if route.calls
+        }
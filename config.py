@@ -4,6 +4,44 @@ MAX_MESSAGE_LENGTH = 4096
 RATE_LIMIT_MESSAGES = 60
 RATE_LIMIT_WINDOW = 60
 
+# Размер страницы в списках заказов и транзакций
+PAGE_SIZE = 10
+
+
+# Каталог услуг: тип -> название, описание, минимальная сумма и комиссия
+SERVICES = {
+    'transfer_eu': {
+        'name': 'Перевод на европейские карты',
+        'description': 'Перевод средств на карты европейских банков',
+        'min_amount': 10,
+        'commission': 0.08
+    },
+    'transfer_us': {
+        'name': 'Перевод на американские карты',
+        'description': 'Перевод средств на карты американских банков',
+        'min_amount': 10,
+        'commission': 0.08
+    },
+    'gpt': {
+        'name': 'GPT',
+        'description': 'Оплата подписки ChatGPT Plus (только Плюс)',
+        'min_amount': 22.4,
+        'commission': 0.08
+    },
+    'twitter': {
+        'name': 'Twitter/X',
+        'description': 'Подписки на Twitter/X (Blue, Premium, Verified)',
+        'min_amount': 8,
+        'commission': 0.08
+    },
+    'other_services': {
+        'name': 'Оплата других сервисов',
+        'description': 'Оплата любых других сервисов и услуг',
+        'min_amount': 10,
+        'commission': 0.08
+    }
+}
+
 
 # Комиссии для разных услуг
 COMMISSION_RATES = {
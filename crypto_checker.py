@@ -6,21 +6,247 @@
 Поддерживает только ETH/USDT и SOL
 """
 
-import requests
+import asyncio
 import time
 import json
 import sqlite3
+import threading
+import hashlib
+import math
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING, ROUND_HALF_UP
+from bisect import bisect_left, bisect_right, insort
 import logging
 import os
 
+from http_client import ResilientHttpClient
+
 logger = logging.getLogger(__name__)
 
+# Размер страницы при инкрементальном сканировании и предел страниц за один цикл
+ETHERSCAN_PAGE_SIZE = 100
+SOLSCAN_PAGE_SIZE = 50
+MAX_SCAN_PAGES = 10
+
+# Максимум хэшей в одном запросе IN (...) к SQLite
+SQLITE_BATCH_SIZE = 500
+
+# Кэш статусов обработанных транзакций в памяти
+PROCESSED_CACHE_SIZE = 10000
+BLOOM_CAPACITY = 100000
+
+# Курсы криптовалют: один запрос за все монеты, кэш на PRICE_CACHE_TTL секунд
+PRICE_API_URL = os.getenv('PRICE_API_URL', 'https://api.coingecko.com/api/v3/simple/price')
+PRICE_CACHE_TTL = int(os.getenv('PRICE_CACHE_TTL', 60))
+
+# Валюта пополнения -> id монеты в CoinGecko
+CURRENCY_COINS = {
+    'eth': 'ethereum',
+    'usdt': 'tether',
+    'sol': 'solana',
+    'usdc_sol': 'usd-coin',
+    'usdt_sol': 'tether'
+}
+
+# Курсы на случай, если API недоступно и кэш пуст
+FALLBACK_PRICES = {
+    'ethereum': 3000.0,
+    'tether': 1.0,
+    'solana': 100.0,
+    'usd-coin': 1.0
+}
+
+# Сопоставление платежей: окно оплаты заказа и допуск по сумме (в шагах валюты)
+PAYMENT_WINDOW_MINUTES = 30
+PAYMENT_TOLERANCE_TICKS = 0
+
+
+class BloomFilter:
+    """Фильтр Блума: отрицательный ответ точен, положительный - вероятностный"""
+    
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class ProcessedTxCache:
+    """Кэш статуса транзакций перед processed_transactions в SQLite
+
+    LRU хранит известный статус (обработана / нет) недавно проверенных
+    хэшей, фильтр Блума содержит все обработанные хэши (прогревается из
+    SQLite при старте). В базу идут только хэши, которых нет в LRU и
+    которые фильтр Блума считает возможно обработанными.
+    """
+    
+    def __init__(self, max_size=PROCESSED_CACHE_SIZE, bloom_capacity=BLOOM_CAPACITY):
+        self.max_size = max_size
+        self.bloom = BloomFilter(bloom_capacity)
+        self._known = OrderedDict()
+        self.counters = {
+            'lru_hits': 0,
+            'bloom_negatives': 0,
+            'db_lookups': 0
+        }
+    
+    @staticmethod
+    def _key(tx_hash, currency):
+        return f"{currency}:{tx_hash}"
+    
+    def _remember(self, key, processed):
+        self._known[key] = processed
+        self._known.move_to_end(key)
+        while len(self._known) > self.max_size:
+            self._known.popitem(last=False)
+    
+    def split(self, tx_hashes, currency):
+        """Разделить хэши на (обработанные, требующие проверки в базе)"""
+        processed, unknown = set(), []
+        for tx_hash in tx_hashes:
+            key = self._key(tx_hash, currency)
+            if key in self._known:
+                self.counters['lru_hits'] += 1
+                self._known.move_to_end(key)
+                if self._known[key]:
+                    processed.add(tx_hash)
+            elif key not in self.bloom:
+                self.counters['bloom_negatives'] += 1
+                self._remember(key, False)
+            else:
+                self.counters['db_lookups'] += 1
+                unknown.append(tx_hash)
+        return processed, unknown
+    
+    def record(self, tx_hashes, currency, processed):
+        """Запомнить результат проверки в базе"""
+        for tx_hash in tx_hashes:
+            self._remember(self._key(tx_hash, currency), tx_hash in processed)
+    
+    def mark_processed(self, tx_hash, currency):
+        key = self._key(tx_hash, currency)
+        self.bloom.add(key)
+        self._remember(key, True)
+    
+    def mark_unprocessed(self, tx_hash, currency):
+        # Из фильтра Блума удалить нельзя - это лишь вызовет проверку в базе
+        self._remember(self._key(tx_hash, currency), False)
+    
+    def stats(self):
+        """Счетчики и доля запросов, обслуженных без обращения к базе"""
+        total = sum(self.counters.values())
+        served = self.counters['lru_hits'] + self.counters['bloom_negatives']
+        return {
+            **self.counters,
+            'hit_rate': round(served / total, 4) if total else 0.0,
+            'lru_size': len(self._known)
+        }
+
+
+class PaymentMatcher:
+    """Индекс ожидающих оплаты заказов по (валюта, ожидаемая сумма)
+
+    Суммы хранятся в целых "шагах" валюты (ticks), по каждой валюте -
+    отсортированный список (шаги, order_id), поиск перевода - бинарный.
+    При регистрации заказу выделяется уникальная сумма: ближайшая сверху,
+    полоса допуска которой не пересекается с другими заказами той же
+    валюты. Поэтому перевод однозначно соответствует не более чем
+    одному заказу.
+    """
+    
+    def __init__(self, ticks, tolerance_ticks=PAYMENT_TOLERANCE_TICKS, window=PAYMENT_WINDOW_MINUTES * 60):
+        self.ticks = ticks
+        self.tolerance = tolerance_ticks
+        self.window = window
+        self._index = {}   # currency -> [(units, order_id)], по возрастанию units
+        self._orders = {}  # order_id -> (currency, units, created_at)
+    
+    def to_units(self, currency, amount, rounding=ROUND_HALF_UP):
+        return int((Decimal(str(amount)) / self.ticks[currency]).to_integral_value(rounding=rounding))
+    
+    def from_units(self, currency, units):
+        return units * self.ticks[currency]
+    
+    def _band(self, currency, units):
+        """Записи индекса в полосе [units - tolerance, units + tolerance]"""
+        entries = self._index.get(currency, [])
+        start = bisect_left(entries, units - self.tolerance, key=lambda e: e[0])
+        end = bisect_right(entries, units + self.tolerance, key=lambda e: e[0])
+        return entries[start:end]
+    
+    def add(self, order_id, currency, units, created_at):
+        self.remove(order_id)
+        insort(self._index.setdefault(currency, []), (units, order_id), key=lambda e: e[0])
+        self._orders[order_id] = (currency, units, created_at)
+    
+    def remove(self, order_id):
+        entry = self._orders.pop(order_id, None)
+        if entry:
+            currency, units, _ = entry
+            self._index[currency].remove((units, order_id))
+    
+    def expire(self, now=None):
+        """Удалить заказы, окно оплаты которых истекло"""
+        now = now or time.time()
+        for order_id, (_, _, created_at) in list(self._orders.items()):
+            if now - created_at > self.window:
+                self.remove(order_id)
+    
+    def allocate(self, currency, amount):
+        """Подобрать уникальную сумму не меньше amount (в шагах валюты)"""
+        units = self.to_units(currency, amount, ROUND_CEILING)
+        # Полосы допуска соседних заказов не должны пересекаться
+        while self._band(currency, units) or self._band(currency, units - self.tolerance) \
+                or self._band(currency, units + self.tolerance):
+            units += 1
+        return units
+    
+    def expected_amount(self, order_id):
+        entry = self._orders.get(order_id)
+        return self.from_units(entry[0], entry[1]) if entry else None
+    
+    def match(self, currency, amount, timestamp, allowed=None):
+        """Найти заказ для перевода: сумма в полосе допуска, время в окне оплаты"""
+        units = self.to_units(currency, amount)
+        timestamp = int(timestamp or 0)
+        for _, order_id in self._band(currency, units):
+            created_at = self._orders[order_id][2]
+            if allowed is not None and order_id not in allowed:
+                continue
+            # Небольшой запас на расхождение часов
+            if created_at - 60 <= timestamp <= created_at + self.window:
+                return order_id
+        return None
+
 
 class SimpleCryptoChecker:
+    SUPPORTED_CURRENCIES = ('eth', 'usdt', 'sol')
+    
     def __init__(self, db_path="bot_database.db"):
         self.db_path = db_path
+        self._http = None
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._processed_cache = ProcessedTxCache()
+        # Недавние переводы по валютам (tx_hash -> перевод), см. _merge_recent_transfers
+        self._recent_transfers = {}
+        # Курсоры последней загрузки, еще не сохраненные (см. commit_scan_cursors)
+        self._scanned_cursors = {}
+        # Валюты, курсор которых нельзя сдвигать: платеж возвращен в обработку
+        self._held_cursors = set()
         
         # API ключи (добавьте в .env)
         self.etherscan_token = os.getenv('ETHERSCAN_TOKEN', 'YOUR_ETHERSCAN_TOKEN')
@@ -33,6 +259,9 @@ class SimpleCryptoChecker:
             'sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq'
         }
         
+        # USDT контракт на Ethereum
+        self.usdt_contract = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+        
         # Минимальные суммы для подтверждения
         self.min_amounts = {
             'eth': 0.001,   # ~$2-3
@@ -40,70 +269,173 @@ class SimpleCryptoChecker:
             'sol': 0.01     # ~$2-3
         }
         
+        # Кэш курсов: coin_id -> цена в USD, время последнего обновления (unix)
+        self._prices = {}
+        self.prices_updated_at = None
+        self._price_refresh_task = None
+        
+        # Шаг суммы для уникальных сумм заказов
+        self.amount_ticks = {
+            'eth': Decimal('0.000001'),
+            'usdt': Decimal('0.01'),
+            'sol': Decimal('0.0001')
+        }
+        self.matcher = PaymentMatcher(self.amount_ticks)
+        
         # Инициализация базы данных
         self._init_database()
+        self._warm_processed_cache()
+        self._load_pending_payments()
+    
+    def _get_connection(self):
+        """Долгоживущее соединение с SQLite (WAL), общее для всех запросов"""
+        if self._conn is None:
+            # Доступ из разных потоков сериализуется через self._db_lock
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=64)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        return self._conn
     
     def _init_database(self):
         """Инициализация базы данных для отслеживания транзакций"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS processed_transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tx_hash TEXT UNIQUE,
-                    currency TEXT,
-                    amount REAL,
-                    order_id INTEGER,
-                    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            conn.commit()
-            conn.close()
+            with self._db_lock:
+                conn = self._get_connection()
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS processed_transactions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        tx_hash TEXT UNIQUE,
+                        currency TEXT,
+                        amount REAL,
+                        order_id INTEGER,
+                        processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_processed_transactions_hash_currency
+                    ON processed_transactions (tx_hash, currency)
+                ''')
+                
+                # Ожидаемые суммы оплаты по заказам (индекс PaymentMatcher)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS pending_payments (
+                        order_id INTEGER PRIMARY KEY,
+                        currency TEXT,
+                        expected_units INTEGER,
+                        created_at REAL
+                    )
+                ''')
+                
+                # Курсоры инкрементального сканирования (последний блок / подпись)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS scan_cursors (
+                        chain TEXT,
+                        address TEXT,
+                        cursor TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (chain, address)
+                    )
+                ''')
+                
+                conn.commit()
             logger.info("База данных инициализирована")
             
         except Exception as e:
             logger.error(f"Ошибка инициализации базы данных: {e}")
     
-    def _is_transaction_processed(self, tx_hash, currency):
-        """Проверить, была ли транзакция уже обработана"""
+    def _processed_transactions(self, tx_hashes, currency):
+        """Вернуть множество уже обработанных хэшей из tx_hashes
+
+        Сначала проверяется кэш в памяти, в SQLite запрашиваются только
+        неизвестные хэши (одним запросом на пачку).
+        """
+        with self._db_lock:
+            processed, unknown = self._processed_cache.split(dict.fromkeys(tx_hashes), currency)
+        if not unknown:
+            return processed
+        
+        found = set()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT id FROM processed_transactions 
-                WHERE tx_hash = ? AND currency = ?
-            ''', (tx_hash, currency))
-            
-            result = cursor.fetchone()
-            conn.close()
+            with self._db_lock:
+                conn = self._get_connection()
+                for start in range(0, len(unknown), SQLITE_BATCH_SIZE):
+                    chunk = unknown[start:start + SQLITE_BATCH_SIZE]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = conn.execute(f'''
+                        SELECT tx_hash FROM processed_transactions
+                        WHERE currency = ? AND tx_hash IN ({placeholders})
+                    ''', (currency, *chunk)).fetchall()
+                    found.update(row[0] for row in rows)
+                self._processed_cache.record(unknown, currency, found)
             
-            return result is not None
+        except Exception as e:
+            logger.error(f"Ошибка проверки транзакций: {e}")
+        return processed | found
+    
+    def _warm_processed_cache(self):
+        """Заполнить фильтр Блума хэшами из processed_transactions"""
+        try:
+            with self._db_lock:
+                rows = self._get_connection().execute(
+                    'SELECT tx_hash, currency FROM processed_transactions'
+                )
+                count = 0
+                for tx_hash, currency in rows:
+                    self._processed_cache.bloom.add(ProcessedTxCache._key(tx_hash, currency))
+                    count += 1
+            logger.info(f"Кэш обработанных транзакций прогрет: {count} записей")
             
         except Exception as e:
-            logger.error(f"Ошибка проверки транзакции: {e}")
-            return False
+            logger.error(f"Ошибка прогрева кэша транзакций: {e}")
+    
+    def processed_cache_stats(self):
+        """Статистика попаданий кэша обработанных транзакций"""
+        with self._db_lock:
+            return self._processed_cache.stats()
     
     def _mark_transaction_processed(self, tx_hash, currency, amount, order_id):
-        """Отметить транзакцию как обработанную"""
+        """Отметить транзакцию как обработанную
+
+        Возвращает True, только если отметку поставил этот вызов: для уже
+        обработанной транзакции (в том числе параллельно) и при ошибке - False.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO processed_transactions (tx_hash, currency, amount, order_id)
-                VALUES (?, ?, ?, ?)
-            ''', (tx_hash, currency, amount, order_id))
+            with self._db_lock:
+                conn = self._get_connection()
+                cursor = conn.execute('''
+                    INSERT OR IGNORE INTO processed_transactions (tx_hash, currency, amount, order_id)
+                    VALUES (?, ?, ?, ?)
+                ''', (tx_hash, currency, amount, order_id))
+                conn.commit()
+                self._processed_cache.mark_processed(tx_hash, currency)
             
-            conn.commit()
-            conn.close()
+            if cursor.rowcount != 1:
+                logger.warning(f"Транзакция {tx_hash} уже обработана")
+                return False
             logger.info(f"Транзакция {tx_hash} отмечена как обработанная")
+            return True
             
         except Exception as e:
             logger.error(f"Ошибка отметки транзакции: {e}")
+            return False
+    
+    def _unmark_transaction_processed(self, tx_hash, currency):
+        """Снять отметку обработки, чтобы транзакция была сопоставлена повторно"""
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('''
+                    DELETE FROM processed_transactions WHERE tx_hash = ? AND currency = ?
+                ''', (tx_hash, currency))
+                conn.commit()
+                self._processed_cache.mark_unprocessed(tx_hash, currency)
+            logger.info(f"Отметка обработки транзакции {tx_hash} снята")
+            
+        except Exception as e:
+            logger.error(f"Ошибка снятия отметки транзакции {tx_hash}: {e}")
     
     def _is_recent_transaction(self, timestamp, minutes=30):
         """Проверить, что транзакция не старше указанного времени"""
@@ -117,191 +449,569 @@ class SimpleCryptoChecker:
         except:
             return False
     
-    def check_eth_payment(self, expected_amount, order_id):
-        """Проверка Ethereum платежа через Etherscan API"""
+    def _get_http(self):
+        """Общий HTTP-клиент с лимитами и повторами (создается при первом запросе)"""
+        if self._http is None:
+            self._http = ResilientHttpClient(timeout=10)
+        return self._http
+    
+    def http_stats(self):
+        """Состояние circuit breaker по провайдерам API"""
+        return {'providers': self._http.stats() if self._http is not None else {}}
+    
+    async def close(self):
+        """Закрыть HTTP-клиент и соединение с базой данных"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def _get_scan_cursor(self, currency):
+        """Последний обработанный блок/подпись для адреса валюты (или None)"""
         try:
-            if self.etherscan_token == 'YOUR_ETHERSCAN_TOKEN':
-                return {'success': False, 'error': 'ETHERSCAN_TOKEN не настроен'}
-            
-            url = "https://api.etherscan.io/api"
-            params = {
-                'module': 'account',
-                'action': 'txlist',
-                'address': self.wallets['eth'],
-                'startblock': 0,
-                'endblock': 99999999,
-                'sort': 'desc',
-                'apikey': self.etherscan_token
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
+            with self._db_lock:
+                result = self._get_connection().execute('''
+                    SELECT cursor FROM scan_cursors
+                    WHERE chain = ? AND address = ?
+                ''', (currency, self.wallets[currency])).fetchone()
             
-            if data.get('status') != '1':
-                return {'success': False, 'error': f"API ошибка: {data.get('message', 'Неизвестная ошибка')}"}
-            
-            transactions = data.get('result', [])
-            
-            # Проверяем последние транзакции
-            for tx in transactions[:10]:  # Проверяем только последние 10
-                if tx.get('to', '').lower() == self.wallets['eth'].lower():
-                    amount_eth = Decimal(tx['value']) / Decimal(10**18)  # Wei в ETH
-                    
-                    # Проверяем сумму и время
-                    if (amount_eth >= self.min_amounts['eth'] and 
-                        self._is_recent_transaction(tx.get('timeStamp'), 30)):
-                        
-                        # Проверяем, не обрабатывали ли мы уже эту транзакцию
-                        if not self._is_transaction_processed(tx['hash'], 'eth'):
-                            return {
-                                'success': True,
-                                'amount': float(amount_eth),
-                                'tx_hash': tx['hash'],
-                                'currency': 'eth',
-                                'order_id': order_id
-                            }
-            
-            return {'success': False, 'message': 'Платеж не найден'}
+            return result[0] if result else None
             
         except Exception as e:
-            logger.error(f"Ошибка проверки ETH платежа: {e}")
-            return {'success': False, 'error': str(e)}
+            logger.error(f"Ошибка чтения курсора сканирования {currency}: {e}")
+            return None
     
-    def check_usdt_payment(self, expected_amount, order_id):
-        """Проверка USDT платежа через Etherscan API"""
+    def _set_scan_cursor(self, currency, value):
+        """Сохранить курсор сканирования для адреса валюты"""
         try:
-            if self.etherscan_token == 'YOUR_ETHERSCAN_TOKEN':
-                return {'success': False, 'error': 'ETHERSCAN_TOKEN не настроен'}
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('''
+                    INSERT INTO scan_cursors (chain, address, cursor, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(chain, address) DO UPDATE SET
+                        cursor = excluded.cursor,
+                        updated_at = excluded.updated_at
+                ''', (currency, self.wallets[currency], str(value)))
+                conn.commit()
             
-            # USDT контракт на Ethereum
-            usdt_contract = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
-            
-            url = "https://api.etherscan.io/api"
-            params = {
-                'module': 'account',
-                'action': 'tokentx',
-                'contractaddress': usdt_contract,
-                'address': self.wallets['usdt'],
-                'startblock': 0,
-                'endblock': 99999999,
-                'sort': 'desc',
+        except Exception as e:
+            logger.error(f"Ошибка сохранения курсора сканирования {currency}: {e}")
+    
+    def commit_scan_cursors(self):
+        """Сохранить курсоры загрузки после обработки найденных платежей
+
+        Курсор сдвигается только после обработки результатов цикла: если
+        бот перезапустится между загрузкой и обработкой, те же блоки будут
+        запрошены снова. Курсор валюты, платеж по которой возвращен в
+        обработку (release_payment), не сдвигается - следующий цикл
+        загрузит этот перевод повторно.
+        """
+        scanned, self._scanned_cursors = self._scanned_cursors, {}
+        held, self._held_cursors = self._held_cursors, set()
+        for currency, value in scanned.items():
+            if currency not in held:
+                self._set_scan_cursor(currency, value)
+    
+    def _merge_recent_transfers(self, currency, transfers):
+        """Добавить новые переводы к буферу недавних и вернуть буфер
+
+        Курсор сдвигается сразу после загрузки, поэтому переводы, которые
+        еще не сопоставлены с заказом, хранятся в памяти, пока не устареют.
+        """
+        buffer = self._recent_transfers.setdefault(currency, {})
+        for transfer in transfers:
+            buffer[transfer['tx_hash']] = transfer
+        for tx_hash in [h for h, t in buffer.items() if not self._is_recent_transaction(t['timestamp'], 30)]:
+            del buffer[tx_hash]
+        return sorted(buffer.values(), key=lambda t: int(t['timestamp'] or 0), reverse=True)
+    
+    @staticmethod
+    def _etherscan_rate_limited(response):
+        """Etherscan сообщает о превышении лимита ответом 200 со status=0"""
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        return data.get('status') == '0' and 'rate limit' in str(data.get('result', '')).lower()
+    
+    async def _etherscan_request(self, params):
+        """Запрос к Etherscan API, возвращает список result"""
+        response = await self._get_http().get(
+            "https://api.etherscan.io/api", params=params, retry_if=self._etherscan_rate_limited
+        )
+        response.raise_for_status()
+        
+        data = response.json()
+        
+        if data.get('status') != '1':
+            # Пустая выборка тоже приходит со status=0
+            if data.get('message') == 'No transactions found':
+                return []
+            raise RuntimeError(f"API ошибка: {data.get('message', 'Неизвестная ошибка')}")
+        
+        return data.get('result', [])
+    
+    async def _fetch_etherscan_transfers(self, currency, params, decimals):
+        """Получить новые входящие переводы на адрес currency через Etherscan API
+
+        Запрашиваются только блоки начиная с сохраненного курсора,
+        постранично, пока не будет получена неполная страница.
+        При первом запуске берется одна страница последних переводов.
+        """
+        if self.etherscan_token == 'YOUR_ETHERSCAN_TOKEN':
+            raise RuntimeError('ETHERSCAN_TOKEN не настроен')
+        
+        address = self.wallets[currency]
+        last_block = self._get_scan_cursor(currency)
+        
+        txs = []
+        for page in range(1, MAX_SCAN_PAGES + 1):
+            query = {
+                **params,
+                'address': address,
+                'page': page,
+                'offset': ETHERSCAN_PAGE_SIZE,
                 'apikey': self.etherscan_token
             }
+            if last_block is None:
+                query['sort'] = 'desc'
+            else:
+                # Блок курсора запрашивается повторно: дубликаты отсекаются по хэшу
+                query.update({'startblock': last_block, 'endblock': 99999999, 'sort': 'asc'})
             
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if data.get('status') != '1':
-                return {'success': False, 'error': f"API ошибка: {data.get('message', 'Неизвестная ошибка')}"}
-            
-            transactions = data.get('result', [])
-            
-            # Проверяем последние транзакции
-            for tx in transactions[:10]:  # Проверяем только последние 10
-                if tx.get('to', '').lower() == self.wallets['usdt'].lower():
-                    amount_usdt = Decimal(tx['value']) / Decimal(10**6)  # USDT имеет 6 десятичных знаков
-                    
-                    # Проверяем сумму и время
-                    if (amount_usdt >= self.min_amounts['usdt'] and 
-                        self._is_recent_transaction(tx.get('timeStamp'), 30)):
-                        
-                        # Проверяем, не обрабатывали ли мы уже эту транзакцию
-                        if not self._is_transaction_processed(tx['hash'], 'usdt'):
-                            return {
-                                'success': True,
-                                'amount': float(amount_usdt),
-                                'tx_hash': tx['hash'],
-                                'currency': 'usdt',
-                                'order_id': order_id
-                            }
-            
-            return {'success': False, 'message': 'Платеж не найден'}
-            
-        except Exception as e:
-            logger.error(f"Ошибка проверки USDT платежа: {e}")
-            return {'success': False, 'error': str(e)}
+            result = await self._etherscan_request(query)
+            txs.extend(result)
+            if last_block is None or len(result) < ETHERSCAN_PAGE_SIZE:
+                break
+        
+        # Страницы идут от старых блоков к новым, поэтому максимальный полученный
+        # блок - позиция, до которой дочитано: если страницы закончились раньше,
+        # следующий цикл продолжит с этого блока (он запрашивается повторно)
+        if txs:
+            self._scanned_cursors[currency] = max(int(tx['blockNumber']) for tx in txs)
+        
+        transfers = []
+        for tx in txs:
+            if tx.get('to', '').lower() == address.lower():
+                transfers.append({
+                    'tx_hash': tx['hash'],
+                    'currency': currency,
+                    'amount': Decimal(tx['value']) / Decimal(10**decimals),
+                    'timestamp': tx.get('timeStamp')
+                })
+        return self._merge_recent_transfers(currency, transfers)
     
-    def check_sol_payment(self, expected_amount, order_id):
-        """Проверка Solana платежа через Solscan API"""
-        try:
-            url = f"https://public-api.solscan.io/account/transactions"
+    async def _fetch_eth_transfers(self):
+        """Входящие ETH переводы (Etherscan txlist)"""
+        return await self._fetch_etherscan_transfers('eth', {
+            'module': 'account',
+            'action': 'txlist'
+        }, 18)  # Wei в ETH
+    
+    async def _fetch_usdt_transfers(self):
+        """Входящие USDT переводы (Etherscan tokentx)"""
+        return await self._fetch_etherscan_transfers('usdt', {
+            'module': 'account',
+            'action': 'tokentx',
+            'contractaddress': self.usdt_contract
+        }, 6)  # USDT имеет 6 десятичных знаков
+    
+    async def _fetch_sol_transfers(self):
+        """Новые входящие SOL переводы (Solscan API)
+
+        Страницы запрашиваются от новых к старым (beforeHash), пока не
+        встретится подпись из курсора. При первом запуске - одна страница.
+        Если за MAX_SCAN_PAGES страниц подпись курсора не встретилась,
+        курсор не переносится на самую новую транзакцию: сохраняется
+        позиция дочитывания ({'until', 'before', 'top'}, JSON), и следующий
+        цикл продолжает с нее, пока не дойдет до прежнего курсора.
+        """
+        cursor = self._get_scan_cursor('sol')
+        if cursor and cursor.startswith('{'):
+            backfill = json.loads(cursor)
+            last_signature, before, top = backfill['until'], backfill['before'], backfill['top']
+        else:
+            last_signature, before, top = cursor, None, None
+        
+        headers = {}
+        if self.solscan_token != 'YOUR_SOLSCAN_TOKEN':
+            headers['Authorization'] = f'Bearer {self.solscan_token}'
+        
+        txs = []
+        complete = False
+        for _ in range(MAX_SCAN_PAGES):
             params = {
                 'account': self.wallets['sol'],
-                'limit': 10
+                'limit': SOLSCAN_PAGE_SIZE
             }
+            if before:
+                params['beforeHash'] = before
             
-            headers = {}
-            if self.solscan_token != 'YOUR_SOLSCAN_TOKEN':
-                headers['Authorization'] = f'Bearer {self.solscan_token}'
-            
-            response = requests.get(url, params=params, headers=headers, timeout=10)
+            response = await self._get_http().get(
+                "https://public-api.solscan.io/account/transactions", params=params, headers=headers
+            )
             response.raise_for_status()
             
             data = response.json()
             
             if not isinstance(data, list):
-                return {'success': False, 'error': 'Неверный формат ответа от Solscan'}
+                raise RuntimeError('Неверный формат ответа от Solscan')
             
-            # Проверяем последние транзакции
+            reached_cursor = False
             for tx in data:
-                if tx.get('status') == 'Success':
-                    # Проверяем входящие транзакции
-                    for instruction in tx.get('parsedInstruction', []):
-                        if instruction.get('type') == 'transfer':
-                            amount_sol = Decimal(instruction.get('info', {}).get('lamports', 0)) / Decimal(10**9)  # Lamports в SOL
-                            
-                            # Проверяем сумму и время
-                            if (amount_sol >= self.min_amounts['sol'] and 
-                                self._is_recent_transaction(tx.get('blockTime'), 30)):
-                                
-                                # Проверяем, не обрабатывали ли мы уже эту транзакцию
-                                if not self._is_transaction_processed(tx['txHash'], 'sol'):
-                                    return {
-                                        'success': True,
-                                        'amount': float(amount_sol),
-                                        'tx_hash': tx['txHash'],
-                                        'currency': 'sol',
-                                        'order_id': order_id
-                                    }
+                if tx.get('txHash') == last_signature:
+                    reached_cursor = True
+                    break
+                txs.append(tx)
             
-            return {'success': False, 'message': 'Платеж не найден'}
+            if reached_cursor or last_signature is None or len(data) < SOLSCAN_PAGE_SIZE:
+                complete = True
+                break
+            before = data[-1]['txHash']
+        
+        newest = top or (txs[0]['txHash'] if txs else None)
+        if complete:
+            if newest:
+                self._scanned_cursors['sol'] = newest
+        elif txs:
+            # Страницы закончились раньше прежнего курсора - дочитать в следующем цикле
+            self._scanned_cursors['sol'] = json.dumps({
+                'until': last_signature,
+                'before': txs[-1]['txHash'],
+                'top': newest
+            })
+            logger.warning(f"SOL: не дошли до курсора за {MAX_SCAN_PAGES} страниц, продолжим в следующем цикле")
+        
+        transfers = []
+        for tx in txs:
+            if tx.get('status') == 'Success':
+                for instruction in tx.get('parsedInstruction', []):
+                    if instruction.get('type') == 'transfer':
+                        transfers.append({
+                            'tx_hash': tx['txHash'],
+                            'currency': 'sol',
+                            'amount': Decimal(instruction.get('info', {}).get('lamports', 0)) / Decimal(10**9),  # Lamports в SOL
+                            'timestamp': tx.get('blockTime')
+                        })
+        return self._merge_recent_transfers('sol', transfers)
+    
+    async def fetch_transfers(self, currency):
+        """Получить последние входящие переводы по валюте
+
+        Вызывается только из цикла сканирования (под payment_scan_lock),
+        поэтому запросы по одной валюте не выполняются одновременно.
+        """
+        fetchers = {
+            'eth': self._fetch_eth_transfers,
+            'usdt': self._fetch_usdt_transfers,
+            'sol': self._fetch_sol_transfers
+        }
+        if currency not in fetchers:
+            raise ValueError(f'Неподдерживаемая валюта: {currency}')
+        return await fetchers[currency]()
+    
+    def _filter_candidates(self, transfers):
+        """Оставить переводы, подходящие для подтверждения: сумма, время, не обработаны ранее
+
+        Проверка по processed_transactions выполняется одним запросом на валюту.
+        """
+        fresh = [t for t in transfers
+                 if t['amount'] >= self.min_amounts[t['currency']]
+                 and self._is_recent_transaction(t['timestamp'], 30)]
+        
+        processed = set()
+        for currency in {t['currency'] for t in fresh}:
+            processed |= self._processed_transactions(
+                [t['tx_hash'] for t in fresh if t['currency'] == currency], currency
+            )
+        return [t for t in fresh if t['tx_hash'] not in processed]
+    
+    @staticmethod
+    def _payment_result(transfer, order_id):
+        return {
+            'success': True,
+            'amount': float(transfer['amount']),
+            'tx_hash': transfer['tx_hash'],
+            'currency': transfer['currency'],
+            'order_id': order_id
+        }
+    
+    async def refresh_prices(self):
+        """Обновить курсы всех монет одним запросом к API"""
+        coin_ids = sorted(set(CURRENCY_COINS.values()))
+        response = await self._get_http().get(PRICE_API_URL, params={
+            'ids': ','.join(coin_ids),
+            'vs_currencies': 'usd'
+        })
+        response.raise_for_status()
+        
+        data = response.json()
+        prices = {coin_id: float(data[coin_id]['usd']) for coin_id in coin_ids if coin_id in data}
+        if not prices:
+            raise RuntimeError('Пустой ответ API курсов')
+        
+        self._prices.update(prices)
+        self.prices_updated_at = time.time()
+        return dict(self._prices)
+    
+    def price_age(self):
+        """Возраст кэша курсов в секундах (None, если курсы еще не загружались)"""
+        if self.prices_updated_at is None:
+            return None
+        return time.time() - self.prices_updated_at
+    
+    async def _refresh_prices_safe(self):
+        try:
+            await self.refresh_prices()
+        except Exception as e:
+            logger.error(f"Ошибка обновления курсов: {e}")
+    
+    async def get_crypto_price(self, coin_id):
+        """Курс монеты в USD
+
+        Свежий кэш отдается сразу; устаревший тоже, но параллельно
+        запускается обновление. Без кэша курс загружается синхронно.
+        """
+        age = self.price_age()
+        if coin_id in self._prices and age is not None:
+            if age > PRICE_CACHE_TTL and (self._price_refresh_task is None or self._price_refresh_task.done()):
+                self._price_refresh_task = asyncio.create_task(self._refresh_prices_safe())
+            return self._prices[coin_id]
+        
+        prices = await self.refresh_prices()
+        if coin_id not in prices:
+            raise ValueError(f'Курс {coin_id} недоступен')
+        return prices[coin_id]
+    
+    def _load_pending_payments(self):
+        """Восстановить индекс ожидающих оплат из SQLite"""
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('DELETE FROM pending_payments WHERE created_at < ?',
+                             (time.time() - self.matcher.window,))
+                conn.commit()
+                rows = conn.execute(
+                    'SELECT order_id, currency, expected_units, created_at FROM pending_payments'
+                ).fetchall()
+            for order_id, currency, units, created_at in rows:
+                self.matcher.add(order_id, currency, units, created_at)
             
         except Exception as e:
-            logger.error(f"Ошибка проверки SOL платежа: {e}")
-            return {'success': False, 'error': str(e)}
-    
-    def check_payment(self, currency, expected_amount, order_id):
-        """Проверить платеж по валюте"""
-        if currency == 'eth':
-            return self.check_eth_payment(expected_amount, order_id)
-        elif currency == 'usdt':
-            return self.check_usdt_payment(expected_amount, order_id)
-        elif currency == 'sol':
-            return self.check_sol_payment(expected_amount, order_id)
-        else:
-            return {'success': False, 'error': f'Неподдерживаемая валюта: {currency}'}
+            logger.error(f"Ошибка загрузки ожидающих оплат: {e}")
+    
+    def register_pending_payment(self, order_id, currency, crypto_amount):
+        """Зарегистрировать заказ и выделить ему уникальную сумму оплаты
+
+        Возвращает сумму (float), которую пользователь должен отправить.
+        """
+        if currency not in self.SUPPORTED_CURRENCIES:
+            return crypto_amount
+        
+        created_at = time.time()
+        self.matcher.expire(created_at)
+        units = self.matcher.allocate(currency, crypto_amount)
+        self.matcher.add(order_id, currency, units, created_at)
+        
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('''
+                    INSERT OR REPLACE INTO pending_payments (order_id, currency, expected_units, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (order_id, currency, units, created_at))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения ожидаемой оплаты заказа {order_id}: {e}")
+        
+        return float(self.matcher.from_units(currency, units))
+    
+    def _forget_pending_payment(self, order_id):
+        """Убрать заказ из индекса ожидающих оплат"""
+        self.matcher.remove(order_id)
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('DELETE FROM pending_payments WHERE order_id = ?', (order_id,))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка удаления ожидаемой оплаты заказа {order_id}: {e}")
+    
+    def _assign_transfers(self, currency, transfers, orders):
+        """Распределить переводы валюты между заказами
+
+        Сопоставляются только заказы с зарегистрированной суммой (окно
+        оплаты не истекло) - по индексу сумм. Заказ без нее не получает
+        ни одного перевода: иначе ему достался бы чужой или случайный.
+        Возвращает список найденных платежей.
+        """
+        registered = {o['order_id'] for o in orders if self.matcher.expected_amount(o['order_id']) is not None}
+        if not registered:
+            return []
+        
+        results = []
+        # От старых к новым: раньше отправленный перевод - раньше созданному заказу
+        for transfer in sorted(transfers, key=lambda t: int(t['timestamp'] or 0)):
+            order_id = self.matcher.match(currency, transfer['amount'], transfer['timestamp'], registered)
+            if order_id is not None:
+                registered.discard(order_id)
+                results.append(self._payment_result(transfer, order_id))
+        return results
+    
+    def awaiting_orders(self, orders):
+        """Заказы, которые еще можно сопоставить: сумма зарегистрирована, окно оплаты не истекло"""
+        self.matcher.expire()
+        return [o for o in orders if self.matcher.expected_amount(o['order_id']) is not None]
+    
+    async def scan_pending_orders(self, orders, max_concurrency=None):
+        """Проверить сразу все ожидающие заказы
+
+        orders - список {'order_id', 'currency', 'expected_amount'}.
+        Переводы каждой сети загружаются один раз за цикл, сети опрашиваются
+        параллельно, затем переводы сопоставляются с заказами в памяти
+        по индексу сумм (PaymentMatcher). max_concurrency ограничивает число
+        одновременных запросов к API.
+        Каждый перевод засчитывается не более чем одному заказу.
+        Возвращает список найденных платежей (см. _payment_result).
+        """
+        # Опрашиваются только сети, по которым есть заказы в окне оплаты
+        orders = self.awaiting_orders(orders)
+        currencies = sorted({o['currency'] for o in orders})
+        if not currencies:
+            return []
+        
+        semaphore = asyncio.Semaphore(max_concurrency or len(currencies))
+        
+        async def fetch(currency):
+            async with semaphore:
+                return await self.fetch_transfers(currency)
+        
+        fetched = await asyncio.gather(
+            *(fetch(currency) for currency in currencies),
+            return_exceptions=True
+        )
+        
+        results = []
+        for currency, transfers in zip(currencies, fetched):
+            if isinstance(transfers, Exception):
+                logger.error(f"Ошибка получения {currency.upper()} переводов: {transfers}")
+                continue
+            currency_orders = [o for o in orders if o['currency'] == currency]
+            results.extend(self._assign_transfers(currency, self._filter_candidates(transfers), currency_orders))
+        return results
+    
+    def _parse_alchemy_activity(self, payload):
+        """Входящие ETH/USDT переводы из уведомления Alchemy Address Activity"""
+        event = payload.get('event') or {}
+        timestamp = int(time.time())
+        if payload.get('createdAt'):
+            try:
+                timestamp = int(datetime.fromisoformat(payload['createdAt'].replace('Z', '+00:00')).timestamp())
+            except ValueError:
+                pass
+        
+        transfers = []
+        for activity in event.get('activity', []):
+            raw = activity.get('rawContract') or {}
+            contract = (raw.get('address') or '').lower()
+            if activity.get('category') in ('external', 'internal') and not contract:
+                currency = 'eth'
+            elif activity.get('category') == 'token' and contract == self.usdt_contract.lower():
+                currency = 'usdt'
+            else:
+                continue
+            if (activity.get('toAddress') or '').lower() != self.wallets[currency].lower():
+                continue
+            
+            decimals = int(raw.get('decimals') or (18 if currency == 'eth' else 6))
+            if raw.get('rawValue'):
+                amount = Decimal(int(raw['rawValue'], 16)) / Decimal(10**decimals)
+            else:
+                amount = Decimal(str(activity.get('value', 0)))
+            transfers.append({
+                'tx_hash': activity['hash'],
+                'currency': currency,
+                'amount': amount,
+                'timestamp': timestamp
+            })
+        return transfers
+    
+    def _parse_helius_transactions(self, payload):
+        """Входящие SOL переводы из уведомления Helius (enhanced transactions)"""
+        transfers = []
+        for tx in payload if isinstance(payload, list) else [payload]:
+            if tx.get('transactionError'):
+                continue
+            for transfer in tx.get('nativeTransfers', []):
+                if transfer.get('toUserAccount') != self.wallets['sol']:
+                    continue
+                transfers.append({
+                    'tx_hash': tx['signature'],
+                    'currency': 'sol',
+                    'amount': Decimal(transfer.get('amount', 0)) / Decimal(10**9),  # Lamports в SOL
+                    'timestamp': tx.get('timestamp') or int(time.time())
+                })
+        return transfers
+    
+    def parse_webhook_transfers(self, provider, payload):
+        """Входящие переводы из push-уведомления провайдера ('alchemy' или 'helius')"""
+        parsers = {
+            'alchemy': self._parse_alchemy_activity,
+            'helius': self._parse_helius_transactions
+        }
+        if provider not in parsers:
+            raise ValueError(f'Неизвестный провайдер уведомлений: {provider}')
+        return parsers[provider](payload or {})
+    
+    def ingest_transfers(self, transfers, orders):
+        """Сопоставить переводы из push-уведомления с ожидающими заказами
+
+        Переводы добавляются в буфер недавних, поэтому несопоставленные
+        будут учтены и следующим циклом опроса. orders и результат - как
+        у scan_pending_orders.
+        """
+        self.matcher.expire()
+        results = []
+        for currency in sorted({t['currency'] for t in transfers}):
+            recent = self._merge_recent_transfers(currency, [t for t in transfers if t['currency'] == currency])
+            currency_orders = [o for o in orders if o['currency'] == currency]
+            if currency_orders:
+                results.extend(self._assign_transfers(currency, self._filter_candidates(recent), currency_orders))
+        return results
     
     def process_payment(self, result):
-        """Обработать найденный платеж"""
+        """Засчитать найденный платеж за заказом (отметить транзакцию обработанной)
+
+        Возвращает False, если платеж не найден или транзакция уже засчитана,
+        в том числе параллельной проверкой. После этого вызывающий код
+        подтверждает заказ и вызывает complete_payment либо, если заказ
+        подтвердить не удалось, release_payment.
+        """
         if result['success']:
-            # Отмечаем транзакцию как обработанную
-            self._mark_transaction_processed(
+            return self._mark_transaction_processed(
                 result['tx_hash'],
                 result['currency'],
                 result['amount'],
                 result['order_id']
             )
-            
-            logger.info(f"Платеж обработан: {result['amount']} {result['currency']} для заказа {result['order_id']}")
-            
-            return True
         else:
             logger.warning(f"Платеж не найден: {result.get('message', result.get('error', 'Неизвестная ошибка'))}")
             return False
+    
+    def complete_payment(self, result):
+        """Заказ подтвержден: больше не ожидать по нему оплату"""
+        self._forget_pending_payment(result['order_id'])
+        logger.info(f"Платеж обработан: {result['amount']} {result['currency']} для заказа {result['order_id']}")
+    
+    def release_payment(self, result):
+        """Заказ подтвердить не удалось: перевод будет сопоставлен следующей проверкой"""
+        self._unmark_transaction_processed(result['tx_hash'], result['currency'])
+        self._held_cursors.add(result['currency'])
+        logger.warning(f"Платеж {result['tx_hash']} для заказа {result['order_id']} возвращен в обработку")
 
 
 # Функция для автоматической выдачи карт (замените на вашу логику)
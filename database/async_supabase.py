@@ -0,0 +1,88 @@
+"""
+Асинхронная обертка над database.supabase_integration.
+
+Синхронные вызовы supabase-py выполняются в ограниченном пуле потоков,
+поэтому медленный запрос к PostgREST не блокирует event loop бота.
+Чтения ограничены таймаутом; при превышении возвращается то же
+значение по умолчанию, что и при ошибке в синхронной функции.
+Изменяющие вызовы (заказы, баланс) таймаутом не прерываются: поток
+все равно довел бы запрос до конца, и ответ "ошибка" при уже
+выполненном зачислении привел бы к повторной операции. Их длительность
+ограничивает таймаут HTTP-клиента supabase-py.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from database import supabase_integration as _sync
+
+logger = logging.getLogger(__name__)
+
+# Таймаут одного обращения к Supabase (секунды) и размер пула потоков
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", 10))
+SUPABASE_MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", 8))
+
+_executor = ThreadPoolExecutor(max_workers=SUPABASE_MAX_WORKERS, thread_name_prefix="supabase")
+
+
+def _async_call(func, default=None, mutating=False):
+    """Превратить синхронную функцию БД в корутину (с таймаутом, если она только читает)"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        if mutating:
+            # Ждем фактический результат: исход изменения должен быть известен
+            return await loop.run_in_executor(_executor, call)
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(_executor, call),
+                timeout or SUPABASE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            # Поток продолжит выполнение, но обработчик больше его не ждет
+            logger.error(f"Таймаут {timeout or SUPABASE_TIMEOUT}с при вызове {func.__name__}")
+            return default() if callable(default) else default
+
+    return wrapper
+
+
+def shutdown_executor(wait=True):
+    """Остановить пул потоков (при завершении бота)"""
+    _executor.shutdown(wait=wait)
+
+
+_get_orders_from_supabase = _async_call(_sync._get_orders_from_supabase, list)
+get_top_wallets = _async_call(_sync.get_top_wallets, list)
+_transition_order_status = _async_call(_sync._transition_order_status, mutating=True)
+_update_order_status_in_supabase = _async_call(_sync._update_order_status_in_supabase, False, mutating=True)
+_get_wallet_info_from_supabase = _async_call(_sync._get_wallet_info_from_supabase)
+_apply_wallet_transaction = _async_call(_sync._apply_wallet_transaction, mutating=True)
+_deposit_wallet_in_supabase = _async_call(_sync._deposit_wallet_in_supabase, False, mutating=True)
+_withdraw_wallet_in_supabase = _async_call(_sync._withdraw_wallet_in_supabase, False, mutating=True)
+_get_user_wallet_data = _async_call(_sync._get_user_wallet_data)
+get_or_create_wallet = _async_call(_sync.get_or_create_wallet)
+ensure_wallets = _async_call(_sync.ensure_wallets, dict)
+update_wallet_balance = _async_call(_sync.update_wallet_balance, False, mutating=True)
+add_money_to_wallet = _async_call(_sync.add_money_to_wallet, False, mutating=True)
+create_order = _async_call(_sync.create_order, mutating=True)
+get_user_orders = _async_call(_sync.get_user_orders, list)
+get_user_transactions = _async_call(_sync.get_user_transactions, list)
+get_all_orders = _async_call(_sync.get_all_orders, list)
+get_user_orders_page = _async_call(_sync.get_user_orders_page, _sync._empty_page)
+get_user_transactions_page = _async_call(_sync.get_user_transactions_page, _sync._empty_page)
+get_all_orders_page = _async_call(_sync.get_all_orders_page, _sync._empty_page)
+get_stats = _async_call(_sync.get_stats, lambda: {
+    "users_count": 0,
+    "orders_count": 0,
+    "total_amount": 0,
+    "total_balance": 0
+})
+get_pending_orders = _async_call(_sync.get_pending_orders, list)
+update_order_status = _async_call(_sync.update_order_status, False, mutating=True)
+get_order_by_id = _async_call(_sync.get_order_by_id)
+get_pending_crypto_orders = _async_call(_sync.get_pending_crypto_orders, list)
@@ -0,0 +1,235 @@
+"""
+Хранилище состояний диалогов пользователей (user_states).
+
+Состояния живут в памяти (LRU, не более STATE_STORE_SIZE записей, каждая
+истекает через STATE_TTL секунд после последней записи) - чтение не
+обращается к диску. Изменения копятся и фоновым потоком пакетно
+сохраняются в SQLite каждые STATE_FLUSH_INTERVAL секунд, а при запуске
+незавершенные диалоги загружаются обратно, поэтому перезапуск бота не
+сбрасывает ввод суммы и выбор валюты. Истекшие состояния раз в
+STATE_SWEEP_INTERVAL секунд удаляются из памяти и из SQLite.
+
+Сохраняются состояния только пока жив файл STATE_DB_PATH: на Render без
+постоянного диска (план free) он создается заново при каждом деплое
+(см. render.yaml). Состояния, которые ссылаются на данные только в
+памяти процесса (кнопки с данными в PayloadCache), при загрузке
+отбрасываются - см. load(drop_states).
+
+Интерфейс - как у словаря: `user_id in store`, `store[user_id]`,
+`store[user_id] = {...}`, `del store[user_id]`.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STATE_STORE_SIZE = int(os.getenv("STATE_STORE_SIZE", 10000))
+STATE_TTL = float(os.getenv("STATE_TTL", 3600))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 2))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", 60))
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_database.db")
+
+# Отсутствие состояния в очереди записи: строку нужно удалить
+_DELETED = object()
+
+
+class StateStore:
+    def __init__(self, db_path=STATE_DB_PATH, max_size=STATE_STORE_SIZE, ttl=STATE_TTL,
+                 flush_interval=STATE_FLUSH_INTERVAL, sweep_interval=STATE_SWEEP_INTERVAL):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.time()
+
+        # user_id -> (state, expires_at), expires_at - unix-время
+        self._data = OrderedDict()
+        # Очередь записи: user_id -> (state, expires_at) или _DELETED
+        self._dirty = {}
+        self._lock = threading.Lock()
+        # Запись в SQLite не держит _lock, чтобы не задерживать чтения
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _get_connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_states (
+                    user_id INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+        return self._conn
+
+    def _evict(self, user_id):
+        """Удалить запись из памяти и поставить удаление в очередь записи"""
+        self._data.pop(user_id, None)
+        self._dirty[user_id] = _DELETED
+
+    def _lookup(self, user_id):
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        state, expires_at = entry
+        if expires_at < time.time():
+            self._evict(user_id)
+            return None
+        self._data.move_to_end(user_id)
+        return state
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._lookup(user_id) is not None
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            state = self._lookup(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            state = self._lookup(user_id)
+        return default if state is None else state
+
+    def __setitem__(self, user_id, state):
+        with self._lock:
+            expires_at = time.time() + self.ttl
+            self._data[user_id] = (state, expires_at)
+            self._data.move_to_end(user_id)
+            self._dirty[user_id] = (state, expires_at)
+            while len(self._data) > self.max_size:
+                oldest = next(iter(self._data))
+                logger.warning(f"Хранилище состояний переполнено, сброшен диалог {oldest}")
+                self._evict(oldest)
+
+    def __delitem__(self, user_id):
+        """Удалить состояние (отсутствие записи - не ошибка: она могла истечь)"""
+        with self._lock:
+            self._evict(user_id)
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self, drop_states=()):
+        """Загрузить незавершенные диалоги из SQLite
+
+        drop_states - значения поля 'state', которые нельзя продолжить после
+        перезапуска: такие диалоги удаляются вместо восстановления.
+        """
+        try:
+            now = time.time()
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.execute('DELETE FROM conversation_states WHERE expires_at < ?', (now,))
+                conn.commit()
+                rows = conn.execute('''
+                    SELECT user_id, state, expires_at FROM conversation_states
+                    ORDER BY expires_at DESC LIMIT ?
+                ''', (self.max_size,)).fetchall()
+            dropped = 0
+            with self._lock:
+                for user_id, state, expires_at in reversed(rows):
+                    state = json.loads(state)
+                    if isinstance(state, dict) and state.get('state') in drop_states:
+                        self._dirty[user_id] = _DELETED
+                        dropped += 1
+                        continue
+                    self._data[user_id] = (state, expires_at)
+            logger.info(f"Загружено состояний диалогов: {len(rows) - dropped}, сброшено: {dropped}")
+
+        except Exception as e:
+            logger.error(f"Ошибка загрузки состояний диалогов: {e}")
+
+    def flush(self):
+        """Сохранить накопленные изменения одной транзакцией"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        upserts = [(user_id, json.dumps(entry[0], ensure_ascii=False, default=str), entry[1])
+                   for user_id, entry in dirty.items() if entry is not _DELETED]
+        deletes = [(user_id,) for user_id, entry in dirty.items() if entry is _DELETED]
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                conn.executemany('''
+                    INSERT INTO conversation_states (user_id, state, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        state = excluded.state,
+                        expires_at = excluded.expires_at
+                ''', upserts)
+                conn.executemany('DELETE FROM conversation_states WHERE user_id = ?', deletes)
+                conn.commit()
+            return len(dirty)
+
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            # Вернуть несохраненное в очередь, не затирая более новые изменения
+            with self._lock:
+                for user_id, entry in dirty.items():
+                    self._dirty.setdefault(user_id, entry)
+            return 0
+
+    def sweep(self):
+        """Удалить истекшие состояния из памяти и из SQLite"""
+        now = time.time()
+        self._last_sweep = now
+        with self._lock:
+            expired = [user_id for user_id, (_, expires_at) in self._data.items() if expires_at < now]
+            for user_id in expired:
+                del self._data[user_id]
+        try:
+            with self._db_lock:
+                conn = self._get_connection()
+                deleted = conn.execute('DELETE FROM conversation_states WHERE expires_at < ?', (now,)).rowcount
+                conn.commit()
+            if expired or deleted:
+                logger.debug(f"Удалено истекших состояний: {len(expired)} в памяти, {deleted} в SQLite")
+
+        except Exception as e:
+            logger.error(f"Ошибка удаления истекших состояний: {e}")
+        return len(expired)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+            if time.time() - self._last_sweep >= self.sweep_interval:
+                self.sweep()
+
+    def start_background_flush(self, drop_states=()):
+        """Загрузить сохраненные диалоги (кроме drop_states) и запустить фоновую запись"""
+        if self._thread and self._thread.is_alive():
+            return
+        self.load(drop_states)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name="state-store", daemon=True)
+        self._thread.start()
+        logger.info(f"Фоновое сохранение состояний запущено (каждые {self.flush_interval}с)")
+
+    def stop(self):
+        """Остановить фоновую запись и сохранить оставшиеся изменения"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+    def stats(self):
+        return {'size': len(self._data), 'pending_writes': len(self._dirty), 'ttl': self.ttl}
+
+
+user_states = StateStore()
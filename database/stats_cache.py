@@ -0,0 +1,158 @@
+"""
+Кэш статистики бота с TTL и stale-while-revalidate.
+
+Используется и Flask-маршрутом /stats (поток Flask), и админ-панелью
+(event loop бота), поэтому кэш потокобезопасен. Свежие данные отдаются
+из памяти; устаревшие (но не старше max_stale) отдаются сразу, а
+обновление запускается в фоне; при отсутствии данных запрос к Supabase
+выполняется синхронно. Фоновый поток периодически обновляет
+запрошенные ранее варианты статистики.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from database.supabase_integration import _fetch_stats
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 30))
+STATS_CACHE_MAX_STALE = float(os.getenv("STATS_CACHE_MAX_STALE", 300))
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", STATS_CACHE_TTL))
+
+
+class StatsCache:
+    def __init__(self, fetch, ttl=STATS_CACHE_TTL, max_stale=STATS_CACHE_MAX_STALE,
+                 refresh_interval=STATS_REFRESH_INTERVAL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.refresh_interval = refresh_interval
+
+        # with_breakdown -> (stats, fetched_at)
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0
+        }
+
+    def _refresh(self, with_breakdown):
+        """Загрузить статистику из Supabase и положить в кэш"""
+        try:
+            stats = self.fetch(with_breakdown=with_breakdown)
+            with self._lock:
+                self._entries[with_breakdown] = (stats, time.monotonic())
+                self.counters['refreshes'] += 1
+            return stats
+        except Exception as e:
+            logger.error(f"Ошибка обновления кэша статистики: {e}")
+            with self._lock:
+                self.counters['refresh_errors'] += 1
+            return None
+        finally:
+            with self._lock:
+                self._refreshing.discard(with_breakdown)
+
+    def _refresh_in_background(self, with_breakdown):
+        """Запустить обновление в отдельном потоке (не более одного на ключ)"""
+        with self._lock:
+            if with_breakdown in self._refreshing:
+                return
+            self._refreshing.add(with_breakdown)
+        threading.Thread(target=self._refresh, args=(with_breakdown,), daemon=True).start()
+
+    def _lookup(self, with_breakdown):
+        """Найти значение в кэше: (stats, age, state), state - hit/stale/miss"""
+        with self._lock:
+            entry = self._entries.get(with_breakdown)
+            if entry is None:
+                return None, None, 'miss'
+            stats, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age <= self.ttl:
+                return stats, age, 'hit'
+            if age <= self.max_stale:
+                return stats, age, 'stale'
+            return None, age, 'miss'
+
+    def _with_cache_info(self, stats, state, age):
+        """Добавить к статистике счетчики кэша"""
+        with self._lock:
+            counters = dict(self.counters)
+        result = dict(stats)
+        result['cache'] = {
+            'status': state,
+            'age': round(age, 3) if age is not None else 0.0,
+            'ttl': self.ttl,
+            **counters
+        }
+        return result
+
+    def get(self, with_breakdown=False):
+        """Получить статистику (блокирует поток только при промахе)"""
+        stats, age, state = self._lookup(with_breakdown)
+
+        if state == 'hit':
+            with self._lock:
+                self.counters['hits'] += 1
+            return self._with_cache_info(stats, state, age)
+
+        if state == 'stale':
+            with self._lock:
+                self.counters['stale_hits'] += 1
+            self._refresh_in_background(with_breakdown)
+            return self._with_cache_info(stats, state, age)
+
+        with self._lock:
+            self.counters['misses'] += 1
+            self._refreshing.add(with_breakdown)
+        stats = self._refresh(with_breakdown)
+        if stats is None:
+            raise RuntimeError("Статистика недоступна")
+        return self._with_cache_info(stats, state, 0.0)
+
+    async def aget(self, with_breakdown=False):
+        """Асинхронная версия get: при промахе запрос выполняется в пуле потоков"""
+        if self._lookup(with_breakdown)[2] == 'miss':
+            return await asyncio.to_thread(self.get, with_breakdown)
+        return self.get(with_breakdown)
+
+    def invalidate(self):
+        """Сбросить кэш"""
+        with self._lock:
+            self._entries.clear()
+
+    def _refresh_loop(self):
+        while not self._stop_event.wait(self.refresh_interval):
+            with self._lock:
+                keys = list(self._entries)
+            for with_breakdown in keys:
+                self._refresh(with_breakdown)
+
+    def start_background_refresh(self):
+        """Запустить фоновое обновление ранее запрошенной статистики"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name="stats-cache", daemon=True)
+        self._thread.start()
+        logger.info(f"Фоновое обновление статистики запущено (каждые {self.refresh_interval}с)")
+
+    def stop(self):
+        """Остановить фоновое обновление"""
+        self._stop_event.set()
+
+
+# Ошибка загрузки должна дойти до кэша: иначе нули заменили бы последние данные
+stats_cache = StatsCache(_fetch_stats)
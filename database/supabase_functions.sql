@@ -0,0 +1,135 @@
+-- Серверные функции Supabase (PostgreSQL), вызываемые через supabase_client.rpc
+-- Применить: Supabase Dashboard -> SQL Editor -> выполнить файл целиком
+
+
+-- Атомарное изменение баланса кошелька с записью транзакции.
+-- Строка кошелька блокируется UPDATE'ом, поэтому параллельные пополнения
+-- не теряют друг друга. Списание не может увести баланс ниже нуля.
+create or replace function apply_wallet_transaction(
+    p_user_id bigint,
+    p_amount numeric,
+    p_transaction_type text,
+    p_description text
+) returns numeric
+language plpgsql
+as $$
+declare
+    v_balance numeric;
+begin
+    update wallets
+       set balance = balance + p_amount,
+           updated_at = now()
+     where user_id = p_user_id
+       and (p_amount >= 0 or balance + p_amount >= 0)
+    returning balance into v_balance;
+
+    if not found then
+        if exists (select 1 from wallets where user_id = p_user_id) then
+            raise exception 'insufficient_funds';
+        end if;
+        raise exception 'wallet_not_found';
+    end if;
+
+    insert into wallet_transactions (user_id, amount, transaction_type, description, created_at)
+    values (p_user_id, p_amount, p_transaction_type, p_description, now());
+
+    return v_balance;
+end;
+$$;
+
+
+-- Создание заказа вместе с первой записью в order_status_history.
+-- Оба INSERT выполняются в одной транзакции: заказ без истории не появится.
+create or replace function create_order_with_history(
+    p_user_id bigint,
+    p_service_type text,
+    p_amount numeric,
+    p_description text,
+    p_notes text default 'Заказ создан'
+) returns orders
+language plpgsql
+as $$
+declare
+    v_order orders;
+begin
+    insert into orders (user_id, service_type, amount, description, status, created_at, updated_at)
+    values (p_user_id, p_service_type, p_amount, p_description, 'pending', now(), now())
+    returning * into v_order;
+
+    insert into order_status_history (order_id, status, admin_id, notes, created_at)
+    values (v_order.id, 'pending', null, p_notes, now());
+
+    return v_order;
+end;
+$$;
+
+
+-- Смена статуса заказа с записью в order_status_history в одной транзакции.
+create or replace function transition_order_status(
+    p_order_id bigint,
+    p_status text,
+    p_admin_id bigint,
+    p_notes text default ''
+) returns orders
+language plpgsql
+as $$
+declare
+    v_order orders;
+begin
+    update orders
+       set status = p_status,
+           updated_at = now()
+     where id = p_order_id
+    returning * into v_order;
+
+    if not found then
+        raise exception 'order_not_found';
+    end if;
+
+    insert into order_status_history (order_id, status, admin_id, notes, created_at)
+    values (p_order_id, p_status, p_admin_id, p_notes, now());
+
+    return v_order;
+end;
+$$;
+
+
+-- Агрегированная статистика бота одним запросом.
+-- С p_with_breakdown = true дополнительно возвращает разбивку заказов
+-- по статусу и типу услуги: {"<ключ>": {"count": N, "amount": S}}.
+create or replace function get_bot_stats(
+    p_with_breakdown boolean default false
+) returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'users_count', (select count(*) from wallets),
+        'orders_count', o.orders_count,
+        'total_amount', o.total_amount,
+        'total_balance', (select coalesce(sum(balance), 0) from wallets),
+        'by_status', case when p_with_breakdown then (
+            select coalesce(jsonb_object_agg(status, jsonb_build_object('count', cnt, 'amount', amt)), '{}'::jsonb)
+              from (select status, count(*) as cnt, coalesce(sum(amount), 0) as amt
+                      from orders group by status) s
+        ) end,
+        'by_service_type', case when p_with_breakdown then (
+            select coalesce(jsonb_object_agg(service_type, jsonb_build_object('count', cnt, 'amount', amt)), '{}'::jsonb)
+              from (select service_type, count(*) as cnt, coalesce(sum(amount), 0) as amt
+                      from orders group by service_type) t
+        ) end
+    )
+    from (select count(*) as orders_count, coalesce(sum(amount), 0) as total_amount from orders) o;
+$$;
+
+
+-- get_or_create_wallet / ensure_wallets используют upsert с on_conflict=user_id
+-- и не передают balance: нужны уникальный user_id и значение баланса по умолчанию.
+alter table wallets alter column balance set default 0;
+create unique index if not exists wallets_user_id_key on wallets (user_id);
+
+
+-- Индексы для keyset-пагинации по (created_at, id)
+create index if not exists orders_user_created_id_idx on orders (user_id, created_at desc, id desc);
+create index if not exists orders_created_id_idx on orders (created_at desc, id desc);
+create index if not exists wallet_transactions_user_created_id_idx on wallet_transactions (user_id, created_at desc, id desc);
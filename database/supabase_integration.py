@@ -1,7 +1,9 @@
 from supabase import create_client, Client
 import os
-from datetime import datetime
 import logging
+from datetime import datetime, timedelta, timezone
+
+from database.wallet_cache import wallet_cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -83,43 +85,57 @@ def get_top_wallets(limit: int = 10):
         raise RuntimeError(f"Ошибка получения кошельков: {e}")
 
 
-def _update_order_status_in_supabase(order_id, new_status, admin_id, notes=''):
-    """Обновить статус заказа в Supabase (внутренняя функция)"""
+def _rpc_row(resp):
+    """Привести ответ RPC, возвращающего строку таблицы, к dict"""
+    data = resp.data
+    if isinstance(data, list):
+        return data[0] if data else None
+    return data
+
+
+def _transition_order_status(order_id, new_status, admin_id, notes=''):
+    """Сменить статус заказа и записать историю одним запросом (внутренняя функция)
+
+    Вызывает RPC transition_order_status (database/supabase_functions.sql).
+    Возвращает обновленную строку заказа или None при ошибке.
+    """
     
     try:
-        # Обновляем статус заказа
-        supabase_client.table("orders").update({
-            "status": new_status,
-            "updated_at": datetime.now().isoformat()
-        }).eq("id", order_id).execute()
-
-        # Добавляем в историю
-        supabase_client.table("order_status_history").insert({
-            "order_id": order_id,
-            "status": new_status,
-            "admin_id": admin_id,
-            "notes": notes,
-            "created_at": datetime.now().isoformat()
+        resp = supabase_client.rpc("transition_order_status", {
+            "p_order_id": order_id,
+            "p_status": new_status,
+            "p_admin_id": admin_id,
+            "p_notes": notes
         }).execute()
-
-        logger.info(f"Статус заказа {order_id} обновлен на '{new_status}' администратором {admin_id}")
-        return True
+        return _rpc_row(resp)
 
     except Exception as e:
         logger.error(f"Ошибка обновления статуса заказа {order_id}: {e}")
+        return None
+
+
+def _update_order_status_in_supabase(order_id, new_status, admin_id, notes=''):
+    """Обновить статус заказа в Supabase (внутренняя функция)"""
+    
+    if not _transition_order_status(order_id, new_status, admin_id, notes):
         return False
 
+    logger.info(f"Статус заказа {order_id} обновлен на '{new_status}' администратором {admin_id}")
+    return True
+
 
 def _get_wallet_info_from_supabase(user_id):
     """Получить информацию о кошельке из Supabase (внутренняя функция)"""
     
     try:
         # Получаем кошелек пользователя
+        snapshot = wallet_cache.snapshot()
         wallet_resp = supabase_client.table("wallets").select("balance, created_at").eq("user_id", user_id).single().execute()
         wallet = wallet_resp.data
 
         if not wallet:
             return None
+        wallet_cache.fill(user_id, wallet['balance'], snapshot)
 
         # Получаем количество транзакций
         transactions_resp = supabase_client.table("wallet_transactions").select("id", count="exact").eq("user_id", user_id).execute()
@@ -137,92 +153,72 @@ def _get_wallet_info_from_supabase(user_id):
         return None
 
 
-def _deposit_wallet_in_supabase(user_id, amount, admin_id):
-    """Пополнить кошелек в Supabase (внутренняя функция)"""
+def _apply_wallet_transaction(user_id, amount, transaction_type, description):
+    """Атомарно изменить баланс и записать транзакцию одним запросом (внутренняя функция)
+
+    Вызывает RPC apply_wallet_transaction (database/supabase_functions.sql).
+    Возвращает новый баланс или None, если кошелек не найден,
+    не хватает средств или произошла ошибка.
+    """
     
     try:
-        if not amount or amount <= 0:
-            logger.error(f"Некорректная сумма для пополнения: {amount}")
-            return False
-
-        # Получаем текущий баланс
-        wallet_resp = supabase_client.table("wallets").select("balance").eq("user_id", user_id).single().execute()
-        wallet = wallet_resp.data
-
-        if not wallet:
-            logger.error(f"Кошелек пользователя {user_id} не найден")
-            return False
+        resp = supabase_client.rpc("apply_wallet_transaction", {
+            "p_user_id": user_id,
+            "p_amount": amount,
+            "p_transaction_type": transaction_type,
+            "p_description": description
+        }).execute()
+        new_balance = float(resp.data)
+        # Write-through: сервер вернул актуальный баланс
+        wallet_cache.set(user_id, new_balance)
+        return new_balance
 
-        new_balance = wallet['balance'] + amount
+    except Exception as e:
+        logger.error(f"Ошибка изменения баланса кошелька пользователя {user_id} на {amount}: {e}")
+        # Результат неизвестен (например, таймаут) - перечитаем баланс при следующем запросе
+        wallet_cache.invalidate(user_id)
+        return None
 
-        # Обновляем баланс кошелька
-        supabase_client.table("wallets").update({"balance": new_balance, "updated_at": datetime.now().isoformat()}).eq("user_id", user_id).execute()
 
-        # Добавляем транзакцию
-        supabase_client.table("wallet_transactions").insert({
-            "user_id": user_id,
-            "amount": amount,
-            "transaction_type": "deposit",
-            "description": f"Пополнение администратором {admin_id}",
-            "created_at": datetime.now().isoformat()
-        }).execute()
-
-        logger.info(f"Кошелек пользователя {user_id} пополнен на {amount} USD администратором {admin_id}")
-        return True
+def _deposit_wallet_in_supabase(user_id, amount, admin_id):
+    """Пополнить кошелек в Supabase (внутренняя функция)"""
+    
+    if not amount or amount <= 0:
+        logger.error(f"Некорректная сумма для пополнения: {amount}")
+        return False
 
-    except Exception as e:
-        logger.error(f"Ошибка пополнения кошелька пользователя {user_id}: {e}")
+    new_balance = _apply_wallet_transaction(user_id, amount, "deposit", f"Пополнение администратором {admin_id}")
+    if new_balance is None:
         return False
 
+    logger.info(f"Кошелек пользователя {user_id} пополнен на {amount} USD администратором {admin_id}")
+    return True
+
 
 def _withdraw_wallet_in_supabase(user_id, amount, admin_id):
     """Вывести средства из кошелька в Supabase (внутренняя функция)"""
-    try:
-        if not amount or amount <= 0:
-            logger.error(f"Некорректная сумма для вывода: {amount}")
-            return False
-
-        # Получаем текущий баланс
-        wallet_resp = supabase_client.table("wallets").select("balance").eq("user_id", user_id).single().execute()
-        wallet = wallet_resp.data
-
-        if not wallet:
-            logger.error(f"Кошелек пользователя {user_id} не найден")
-            return False
-
-        current_balance = wallet['balance']
-        if current_balance < amount:
-            logger.error(f"Недостаточно средств для вывода: {current_balance} < {amount}")
-            return False
-
-        new_balance = current_balance - amount
-
-        # Обновляем баланс кошелька
-        supabase_client.table("wallets").update({"balance": new_balance, "updated_at": datetime.now().isoformat()}).eq("user_id", user_id).execute()
-
-        # Добавляем транзакцию
-        supabase_client.table("wallet_transactions").insert({
-            "user_id": user_id,
-            "amount": -amount,
-            "transaction_type": "withdraw",
-            "description": f"Вывод администратором {admin_id}",
-            "created_at": datetime.now().isoformat()
-        }).execute()
-
-        logger.info(f"Из кошелька пользователя {user_id} выведено {amount} USD администратором {admin_id}")
-        return True
+    
+    if not amount or amount <= 0:
+        logger.error(f"Некорректная сумма для вывода: {amount}")
+        return False
 
-    except Exception as e:
-        logger.error(f"Ошибка вывода средств из кошелька пользователя {user_id}: {e}")
+    # Проверка достаточности средств выполняется в той же транзакции на сервере
+    new_balance = _apply_wallet_transaction(user_id, -amount, "withdraw", f"Вывод администратором {admin_id}")
+    if new_balance is None:
         return False
 
+    logger.info(f"Из кошелька пользователя {user_id} выведено {amount} USD администратором {admin_id}")
+    return True
+
 
 def _get_user_wallet_data(user_id):
     """Получить данные кошелька пользователя"""
     
     try:
+        snapshot = wallet_cache.snapshot()
         existing = supabase_client.table("wallets").select("balance").eq("user_id", user_id).execute()
         if existing.data:
+            wallet_cache.fill(user_id, existing.data[0]["balance"], snapshot)
             return existing.data[0]
         return None
     except Exception as e:
@@ -234,17 +230,18 @@ def get_or_create_wallet(user_id, username=None, first_name=None):
     """Получить или создать кошелек пользователя"""
     
     try:
-        # Проверяем существование кошелька
-        existing = supabase_client.table("wallets").select("balance").eq("user_id", user_id).execute()
-        if existing.data:
-            return existing.data[0]
-        
-        # Создаем новый кошелек
-        supabase_client.table("wallets").insert({"user_id": user_id, "balance": 0.0}).execute()
-        
-        # Получаем созданный кошелек
-        wallet = supabase_client.table("wallets").select("*").eq("user_id", user_id).execute()
+        # Один запрос: INSERT ... ON CONFLICT (user_id) DO UPDATE ... RETURNING *
+        # В payload нет balance, поэтому баланс существующего кошелька не меняется
+        row = {"user_id": user_id}
+        if username is not None:
+            row["username"] = username
+        if first_name is not None:
+            row["first_name"] = first_name
+
+        snapshot = wallet_cache.snapshot()
+        wallet = supabase_client.table("wallets").upsert(row, on_conflict="user_id").execute()
         if wallet.data:
+            wallet_cache.fill(user_id, wallet.data[0]["balance"], snapshot)
             return wallet.data[0]
         
         # Если не удалось получить, создаем базовый объект
@@ -252,53 +249,38 @@ def get_or_create_wallet(user_id, username=None, first_name=None):
         
     except Exception as e:
         logger.error(f"Ошибка создания/получения кошелька пользователя {user_id}: {e}")
-        # Создаем базовый объект кошелька
-        try:
-            supabase_client.table("wallets").insert({
-                "user_id": user_id,
-                "username": username,
-                "first_name": first_name,
-                "balance": 0.0,
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }).execute()
-        except Exception as insert_error:
-            logger.error(f"Ошибка создания кошелька в блоке except: {insert_error}")
         return {"user_id": user_id, "balance": 0.0}
 
 
-def update_wallet_balance(user_id, amount, transaction_type, description):
-    """Обновить баланс кошелька"""
+def ensure_wallets(user_ids):
+    """Получить или создать кошельки для нескольких пользователей одним запросом
+
+    Возвращает словарь user_id -> строка кошелька.
+    """
     
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+
     try:
-        # Получаем текущий баланс
-        wallet_resp = supabase_client.table("wallets").select("balance").eq("user_id", user_id).execute()
-        if not wallet_resp.data:
-            logger.error(f"Кошелек пользователя {user_id} не найден")
-            return False
-        
-        current_balance = wallet_resp.data[0]['balance']
-        new_balance = current_balance + amount
-        
-        # Обновляем баланс
-        supabase_client.table("wallets").update({
-            "balance": new_balance,
-            "updated_at": datetime.now().isoformat()
-        }).eq("user_id", user_id).execute()
-        
-        # Добавляем транзакцию
-        supabase_client.table("wallet_transactions").insert({
-            "user_id": user_id,
-            "amount": amount,
-            "transaction_type": transaction_type,
-            "description": description,
-            "created_at": datetime.now().isoformat()
-        }).execute()
-        
-        return True
+        snapshot = wallet_cache.snapshot()
+        wallets = supabase_client.table("wallets")\
+            .upsert([{"user_id": user_id} for user_id in user_ids], on_conflict="user_id")\
+            .execute()
+        result = {}
+        for wallet in wallets.data or []:
+            wallet_cache.fill(wallet["user_id"], wallet["balance"], snapshot)
+            result[wallet["user_id"]] = wallet
+        return result
     except Exception as e:
-        logger.error(f"Ошибка обновления баланса кошелька пользователя {user_id}: {e}")
-        return False
+        logger.error(f"Ошибка создания/получения кошельков {len(user_ids)} пользователей: {e}")
+        return {}
+
+
+def update_wallet_balance(user_id, amount, transaction_type, description):
+    """Обновить баланс кошелька"""
+    
+    return _apply_wallet_transaction(user_id, amount, transaction_type, description) is not None
 
 
 def add_money_to_wallet(user_id, amount, description):
@@ -310,31 +292,14 @@ def create_order(user_id, service_type, amount, description):
     """Создать заказ"""
     
     try:
-        order_resp = supabase_client.table("orders").insert({
-            "user_id": user_id,
-            "service_type": service_type,
-            "amount": amount,
-            "description": description,
-            "status": "pending",
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+        # Заказ и запись в историю статусов создаются в одной транзакции
+        order_resp = supabase_client.rpc("create_order_with_history", {
+            "p_user_id": user_id,
+            "p_service_type": service_type,
+            "p_amount": amount,
+            "p_description": description
         }).execute()
-        
-        if order_resp.data:
-            order_id = order_resp.data[0]['id']
-            
-            # Добавляем в историю статусов
-            supabase_client.table("order_status_history").insert({
-                "order_id": order_id,
-                "status": "pending",
-                "admin_id": None,
-                "notes": "Заказ создан",
-                "created_at": datetime.now().isoformat()
-            }).execute()
-            
-            return order_resp.data[0]
-        
-        return None
+        return _rpc_row(order_resp)
     except Exception as e:
         logger.error(f"Ошибка создания заказа для пользователя {user_id}: {e}")
         return None
@@ -389,28 +354,139 @@ def get_all_orders(limit: int = 50):
         return []
 
 
-def get_stats():
-    """Получить статистику"""
+# Keyset-пагинация по (created_at, id): курсор указывает на крайнюю строку
+# страницы, следующая страница запрашивается фильтром "строго после курсора".
+# Курсор компактный ("<микросекунды>.<id>"), чтобы помещаться в callback_data.
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _encode_cursor(row):
+    """Закодировать позицию строки (created_at, id) в короткую строку"""
+    created_at = datetime.fromisoformat(row["created_at"])
+    # Для timestamp без часового пояса добавляем суффикс n, чтобы восстановить формат
+    suffix = "" if created_at.tzinfo else "n"
+    if not created_at.tzinfo:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}.{row['id']}{suffix}"
+
+
+def _decode_cursor(cursor):
+    """Раскодировать курсор в (created_at в ISO-формате, id)"""
+    naive = cursor.endswith("n")
+    micros, row_id = cursor.rstrip("n").split(".")
+    created_at = _EPOCH + timedelta(microseconds=int(micros))
+    if naive:
+        created_at = created_at.replace(tzinfo=None)
+    return created_at.isoformat(), int(row_id)
+
+
+def _keyset_page(query, cursor=None, direction="next", limit=10):
+    """Получить одну страницу (от новых к старым) запроса PostgREST
+
+    direction="next" - строки старше курсора, "prev" - новее курсора.
+    Возвращает {'items', 'next_cursor', 'prev_cursor'}; курсор None,
+    если в этом направлении страниц больше нет.
+    """
+    if cursor:
+        created_at, row_id = _decode_cursor(cursor)
+        op = "lt" if direction == "next" else "gt"
+        query = query.or_(
+            f'created_at.{op}."{created_at}",'
+            f'and(created_at.eq."{created_at}",id.{op}.{row_id})'
+        )
+
+    desc = direction == "next"
+    # Берем на одну строку больше, чтобы узнать, есть ли еще страница
+    resp = query.order("created_at", desc=desc).order("id", desc=desc).limit(limit + 1).execute()
+    rows = resp.data or []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not desc:
+        rows.reverse()
+
+    if direction == "next":
+        has_next, has_prev = has_more, cursor is not None
+    else:
+        has_next, has_prev = True, has_more
+
+    return {
+        'items': rows,
+        'next_cursor': _encode_cursor(rows[-1]) if rows and has_next else None,
+        'prev_cursor': _encode_cursor(rows[0]) if rows and has_prev else None
+    }
+
+
+def _empty_page():
+    return {'items': [], 'next_cursor': None, 'prev_cursor': None}
+
+
+def get_user_orders_page(user_id, cursor=None, direction="next", limit=10):
+    """Получить страницу заказов пользователя"""
     
     try:
-        users_resp = supabase_client.table("wallets").select("user_id", count="exact").execute()
-        users_count = users_resp.count or 0
-        
-        orders_resp = supabase_client.table("orders").select("id", count="exact").execute()
-        orders_count = orders_resp.count or 0
-        
-        total_amount_resp = supabase_client.table("orders").select("amount").execute()
-        total_amount = sum([o["amount"] for o in total_amount_resp.data]) if total_amount_resp.data else 0
-        
-        total_balance_resp = supabase_client.table("wallets").select("balance").execute()
-        total_balance = sum([w["balance"] for w in total_balance_resp.data]) if total_balance_resp.data else 0
-        
-        return {
-            "users_count": users_count,
-            "orders_count": orders_count,
-            "total_amount": total_amount,
-            "total_balance": total_balance
-        }
+        query = supabase_client.table("orders")\
+            .select("id,service_type,amount,status,created_at")\
+            .eq("user_id", user_id)
+        return _keyset_page(query, cursor, direction, limit)
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы заказов пользователя {user_id}: {e}")
+        return _empty_page()
+
+
+def get_user_transactions_page(user_id, cursor=None, direction="next", limit=10):
+    """Получить страницу транзакций пользователя"""
+    
+    try:
+        query = supabase_client.table("wallet_transactions")\
+            .select("id,amount,transaction_type,description,created_at")\
+            .eq("user_id", user_id)
+        return _keyset_page(query, cursor, direction, limit)
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы транзакций пользователя {user_id}: {e}")
+        return _empty_page()
+
+
+def get_all_orders_page(cursor=None, direction="next", limit=10):
+    """Получить страницу всех заказов"""
+    
+    try:
+        query = supabase_client.table("orders")\
+            .select("id,user_id,service_type,amount,status,created_at")
+        return _keyset_page(query, cursor, direction, limit)
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы всех заказов: {e}")
+        return _empty_page()
+
+
+def _fetch_stats(with_breakdown=False):
+    """Получить статистику (внутренняя функция, ошибки не перехватываются)
+
+    Все суммы и счетчики считаются в PostgreSQL (RPC get_bot_stats),
+    строки таблиц в Python не загружаются. С with_breakdown=True
+    добавляются разбивки by_status и by_service_type.
+    """
+    
+    stats_resp = supabase_client.rpc("get_bot_stats", {"p_with_breakdown": with_breakdown}).execute()
+    data = stats_resp.data or {}
+    
+    stats = {
+        "users_count": data.get("users_count", 0),
+        "orders_count": data.get("orders_count", 0),
+        "total_amount": float(data.get("total_amount", 0)),
+        "total_balance": float(data.get("total_balance", 0))
+    }
+    if with_breakdown:
+        stats["by_status"] = data.get("by_status") or {}
+        stats["by_service_type"] = data.get("by_service_type") or {}
+    return stats
+
+
+def get_stats(with_breakdown=False):
+    """Получить статистику (при ошибке - нули)"""
+    
+    try:
+        return _fetch_stats(with_breakdown)
     except Exception as e:
         logger.error(f"Ошибка получения статистики: {e}")
         return {
@@ -438,26 +514,7 @@ def get_pending_orders():
 
 def update_order_status(order_id, new_status, admin_id, notes=''):
     """Обновить статус заказа"""
-    try:
-        # Обновляем статус заказа
-        supabase_client.table("orders").update({
-            "status": new_status,
-            "updated_at": datetime.now().isoformat()
-        }).eq("id", order_id).execute()
-        
-        # Добавляем в историю
-        supabase_client.table("order_status_history").insert({
-            "order_id": order_id,
-            "status": new_status,
-            "admin_id": admin_id,
-            "notes": notes,
-            "created_at": datetime.now().isoformat()
-        }).execute()
-        
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка обновления статуса заказа {order_id}: {e}")
-        return False
+    return _transition_order_status(order_id, new_status, admin_id, notes) is not None
 
 
 def get_order_by_id(order_id):
@@ -482,7 +539,7 @@ def get_pending_crypto_orders():
         pending_resp = supabase_client.table("orders")\
             .select("id, user_id, service_type, amount")\
             .eq("status", "pending")\
-            .like("service_type", "crypto_%")\
+            .or_("service_type.like.crypto_%,service_type.like.deposit_crypto_%")\
             .execute()
         return pending_resp.data or []
     except Exception as e:
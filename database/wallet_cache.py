@@ -0,0 +1,101 @@
+"""
+LRU-кэш балансов кошельков в памяти процесса.
+
+Заполняется при чтении кошелька и обновляется write-through при каждом
+изменении баланса в database.supabase_integration, поэтому навигация по
+меню не требует запроса к Supabase. Размер и время жизни записей
+ограничены (WALLET_CACHE_SIZE, WALLET_CACHE_TTL).
+
+Значение, прочитанное из базы, кладется через fill() с меткой начала
+чтения (snapshot()): если за время чтения баланс изменили (set или
+invalidate), прочитанное значение старее и отбрасывается.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+WALLET_CACHE_SIZE = int(os.getenv("WALLET_CACHE_SIZE", 10000))
+WALLET_CACHE_TTL = float(os.getenv("WALLET_CACHE_TTL", 60))
+
+
+class BalanceCache:
+    def __init__(self, max_size=WALLET_CACHE_SIZE, ttl=WALLET_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (balance, expires_at)
+        self._data = OrderedDict()
+        # Счетчик изменений и номер последнего изменения по пользователю;
+        # для вытесненных записей используется _writes_floor
+        self._seq = 0
+        self._writes = OrderedDict()
+        self._writes_floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Баланс из кэша или None, если записи нет или она устарела"""
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            balance, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return balance
+
+    def _store(self, user_id, balance):
+        self._data[user_id] = (float(balance), time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _record_write(self, user_id):
+        self._seq += 1
+        self._writes[user_id] = self._seq
+        self._writes.move_to_end(user_id)
+        while len(self._writes) > self.max_size:
+            _, seq = self._writes.popitem(last=False)
+            self._writes_floor = max(self._writes_floor, seq)
+
+    def snapshot(self):
+        """Метка начала чтения баланса из базы (для fill)"""
+        with self._lock:
+            return self._seq
+
+    def fill(self, user_id, balance, snapshot):
+        """Записать баланс, прочитанный из базы, если с начала чтения он не менялся"""
+        with self._lock:
+            if self._writes.get(user_id, self._writes_floor) > snapshot:
+                return False
+            self._store(user_id, balance)
+            return True
+
+    def set(self, user_id, balance):
+        """Записать актуальный баланс (после изменения)"""
+        with self._lock:
+            self._record_write(user_id)
+            self._store(user_id, balance)
+
+    def invalidate(self, user_id):
+        """Удалить запись (баланс мог измениться, но новое значение неизвестно)"""
+        with self._lock:
+            self._record_write(user_id)
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+wallet_cache = BalanceCache()
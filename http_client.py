@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Общий HTTP-клиент для внешних API (Etherscan, Solscan, курсы)
+
+- пул соединений с keep-alive (один httpx.AsyncClient на процесс)
+- ограничение частоты запросов на каждый хост (token bucket)
+- повтор с экспоненциальной задержкой при 429/5xx и сетевых ошибках
+- circuit breaker на каждый хост: после серии ошибок запросы к нему
+  временно не отправляются
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Лимиты запросов в секунду по хостам (Etherscan free: 5 req/s)
+HOST_RATE_LIMITS = {
+    'api.etherscan.io': float(os.getenv('ETHERSCAN_RATE_LIMIT', 5)),
+    'public-api.solscan.io': float(os.getenv('SOLSCAN_RATE_LIMIT', 5)),
+    'api.coingecko.com': float(os.getenv('PRICE_API_RATE_LIMIT', 0.5))
+}
+DEFAULT_RATE_LIMIT = 10
+
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    """Запросы к хосту временно отключены после серии ошибок"""
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """Closed -> open после threshold ошибок подряд -> half-open через reset_timeout"""
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Можно ли отправить запрос (в half-open - только один пробный)"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+
+class ResilientHttpClient:
+    """Асинхронный HTTP-клиент с лимитами, повторами и circuit breaker по хостам"""
+
+    def __init__(self, timeout=10, rate_limits=None, max_retries=MAX_RETRIES):
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+        )
+        self.rate_limits = {**HOST_RATE_LIMITS, **(rate_limits or {})}
+        self.max_retries = max_retries
+        self._buckets = {}
+        self._breakers = {}
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.rate_limits.get(host, DEFAULT_RATE_LIMIT))
+        return self._buckets[host]
+
+    def breaker(self, host):
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker()
+        return self._breakers[host]
+
+    @staticmethod
+    def _retry_delay(attempt, response=None):
+        """Задержка перед повтором: Retry-After или экспонента с джиттером"""
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(RETRY_MAX_DELAY, int(response.headers['Retry-After']))
+        return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def get(self, url, params=None, headers=None, retry_if=None):
+        """GET-запрос с учетом лимитов хоста
+
+        retry_if(response) -> bool позволяет повторять успешные по HTTP,
+        но отклоненные API ответы (например, лимит Etherscan со status=0).
+        Бросает CircuitOpenError, если хост временно отключен.
+        """
+        host = urlsplit(url).hostname
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"{host}: слишком много ошибок, запросы приостановлены")
+
+        response = None
+        for attempt in range(self.max_retries + 1):
+            await self._bucket(host).acquire()
+            try:
+                response = await self._client.get(url, params=params, headers=headers)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    breaker.record_failure()
+                    raise
+                logger.warning(f"{host}: сетевая ошибка ({e}), повтор {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            retryable = response.status_code in RETRYABLE_STATUS_CODES or (retry_if and retry_if(response))
+            if not retryable:
+                breaker.record_success()
+                return response
+            if attempt < self.max_retries:
+                logger.warning(f"{host}: ответ {response.status_code}, повтор {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(self._retry_delay(attempt, response))
+
+        breaker.record_failure()
+        return response
+
+    def stats(self):
+        """Состояние circuit breaker по хостам"""
+        return {host: {'state': b.state, 'failures': b.failures} for host, b in self._breakers.items()}
+
+    async def aclose(self):
+        await self._client.aclose()
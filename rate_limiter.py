@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ограничение частоты запросов пользователей (GCRA)
+
+Для каждого ключа хранится одно число - теоретическое время прибытия
+(TAT) следующего запроса, поэтому память на пользователя постоянна.
+Лимит: не более `limit` запросов за `window` секунд, всплеск до `limit`.
+Записи, у которых TAT уже в прошлом, ничего не ограничивают и
+периодически удаляются.
+
+Бэкенды:
+- MemoryRateLimitBackend - в памяти процесса (по умолчанию)
+- SQLiteRateLimitBackend - общий файл SQLite для нескольких процессов
+  на одной машине
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryRateLimitBackend:
+    """Хранение TAT в словаре процесса"""
+
+    def __init__(self):
+        self._tat = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now, interval, tolerance):
+        """Атомарно проверить и учесть запрос: (разрешен, через сколько секунд повторить)"""
+        with self._lock:
+            tat = max(self._tat.get(key, now), now)
+            if tat - now > tolerance:
+                return False, tat - now - tolerance
+            self._tat[key] = tat + interval
+            return True, 0.0
+
+    def evict(self, now):
+        """Удалить записи, которые больше не ограничивают запросы"""
+        with self._lock:
+            idle = [key for key, tat in self._tat.items() if tat <= now]
+            for key in idle:
+                del self._tat[key]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._tat)
+
+
+class SQLiteRateLimitBackend:
+    """Хранение TAT в SQLite: лимиты общие для всех процессов с этим файлом"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY,
+                tat REAL NOT NULL
+            )
+        ''')
+
+    def acquire(self, key, now, interval, tolerance):
+        with self._lock:
+            # BEGIN IMMEDIATE - чтение и запись TAT атомарны между процессами
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT tat FROM rate_limits WHERE key = ?', (str(key),)).fetchone()
+                tat = max(row[0] if row else now, now)
+                if tat - now > tolerance:
+                    return False, tat - now - tolerance
+                self._conn.execute('''
+                    INSERT INTO rate_limits (key, tat) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET tat = excluded.tat
+                ''', (str(key), tat + interval))
+                return True, 0.0
+            finally:
+                self._conn.execute('COMMIT')
+
+    def evict(self, now):
+        with self._lock:
+            return self._conn.execute('DELETE FROM rate_limits WHERE tat <= ?', (now,)).rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+
+
+class RateLimiter:
+    """Не более limit запросов за window секунд на ключ"""
+
+    def __init__(self, limit, window, backend=None):
+        self.limit = limit
+        self.window = window
+        self.interval = window / limit
+        self.tolerance = window - self.interval
+        self.backend = backend if backend is not None else MemoryRateLimitBackend()
+        # Неблокирующий бэкенд вызывается прямо в event loop
+        self._blocking = not isinstance(self.backend, MemoryRateLimitBackend)
+        self._last_eviction = time.time()
+        # ключ -> время, до которого пользователь уже предупрежден
+        self._notified = {}
+        self.allowed = 0
+        self.rejected = 0
+
+    def _hit(self, key):
+        now = time.time()
+        if now - self._last_eviction >= self.window:
+            self._last_eviction = now
+            evicted = self.backend.evict(now)
+            self._notified = {k: until for k, until in self._notified.items() if until > now}
+            if evicted:
+                logger.debug(f"Rate limiter: удалено неактивных записей: {evicted}")
+
+        allowed, retry_after = self.backend.acquire(key, now, self.interval, self.tolerance)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.rejected += 1
+        return allowed, retry_after
+
+    async def hit(self, key):
+        """Учесть запрос ключа: (разрешен, через сколько секунд повторить)"""
+        if self._blocking:
+            return await asyncio.to_thread(self._hit, key)
+        return self._hit(key)
+
+    def should_notify(self, key, retry_after):
+        """Сообщать об ограничении один раз, пока оно действует"""
+        now = time.time()
+        if self._notified.get(key, 0) > now:
+            return False
+        self._notified[key] = now + retry_after
+        return True
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'window': self.window,
+            'active_keys': len(self.backend),
+            'allowed': self.allowed,
+            'rejected': self.rejected
+        }
+
+
+def create_rate_limiter(limit, window, backend='memory', db_path='rate_limits.db'):
+    """Лимитер с бэкендом по имени ('memory' или 'sqlite')"""
+    if backend == 'sqlite':
+        return RateLimiter(limit, window, SQLiteRateLimitBackend(db_path))
+    if backend != 'memory':
+        logger.warning(f"Неизвестный бэкенд rate limiter '{backend}', используется memory")
+    return RateLimiter(limit, window)
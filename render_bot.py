@@ -1,27 +1,48 @@
 import os
 import logging
 import asyncio
+import signal
 import sys
+import threading
+import time
+import hmac
+import hashlib
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler,
+    filters, ContextTypes
+)
 from flask import Flask, request, jsonify
 from datetime import datetime
-from crypto_checker import auto_issue_card
-from database.supabase_integration import (
-    _update_order_status_in_supabase, 
-    get_top_wallets,
+from update_processor import PerChatUpdateProcessor
+from callback_router import CallbackRouter
+from crypto_checker import SimpleCryptoChecker, CURRENCY_COINS, FALLBACK_PRICES, PRICE_CACHE_TTL, auto_issue_card
+from config import MAX_MESSAGE_LENGTH, PAGE_SIZE, RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW, SERVICES
+from user_messages import (
+    WELCOME_TEMPLATE, MAIN_MENU_KEYBOARD, ADMIN_MAIN_MENU_KEYBOARD, HELP_TEXT,
+    CATALOG_TEXT, CATALOG_KEYBOARD, TRANSFERS_TEXT, TRANSFERS_KEYBOARD,
+    OTHER_SERVICES_TEXT, OTHER_SERVICES_KEYBOARD, PAYMENT_SERVICES_TEXT, PAYMENT_SERVICES_KEYBOARD,
+    SERVICE_ORDER_TEXTS, WALLET_TEMPLATE, WALLET_KEYBOARD, DEPOSIT_OPTIONS_TEXT, DEPOSIT_OPTIONS_KEYBOARD,
+    ADMIN_PANEL_TEXT, ADMIN_PANEL_KEYBOARD, back_keyboard
+)
+from rate_limiter import create_rate_limiter
+from database.stats_cache import stats_cache
+from database.wallet_cache import wallet_cache
+from database.state_store import user_states
+from database.async_supabase import (
     _get_user_wallet_data,
+    get_top_wallets,
     get_or_create_wallet,
     update_wallet_balance,
     add_money_to_wallet,
     create_order,
-    get_user_orders,
-    get_user_transactions,
-    get_all_orders,
-    get_stats,
+    get_user_orders_page,
+    get_user_transactions_page,
+    get_all_orders_page,
     update_order_status,
     get_order_by_id,
-    get_pending_crypto_orders
+    get_pending_crypto_orders,
+    shutdown_executor
 )
 
 
@@ -52,44 +73,103 @@ OPERATOR_USERNAME = "@myspacehelper"
 PORT = int(os.getenv('PORT', 10000))
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'local')  # 'local' или 'production'
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Для Render
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')  # Заголовок X-Telegram-Bot-Api-Secret-Token
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))  # Обновлений в обработке одновременно
 
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
 
 print(f"TELEGRAM BOT TOKEN: {'✅ Установлен' if TELEGRAM_BOT_TOKEN else '❌ НЕ УСТАНОВЛЕН'}")
 
-# Кэш для rate limiting
-user_message_times = {}
+# Ограничение частоты запросов: RATE_LIMIT_MESSAGES за RATE_LIMIT_WINDOW секунд
+# RATE_LIMIT_BACKEND=sqlite - общий лимит для нескольких процессов (файл RATE_LIMIT_DB)
+rate_limiter = create_rate_limiter(
+    RATE_LIMIT_MESSAGES,
+    RATE_LIMIT_WINDOW,
+    backend=os.getenv('RATE_LIMIT_BACKEND', 'memory'),
+    db_path=os.getenv('RATE_LIMIT_DB', 'rate_limits.db')
+)
 
-# Система состояний пользователей
-user_states = {}
 
 # Глобальная переменная для крипточекера
 crypto_checker = None
 
+# Маршруты inline-кнопок регистрируются декоратором @callback_router.route
+callback_router = CallbackRouter(is_admin=lambda user_id: user_id in ADMIN_IDS)
+
+# Push-уведомления о переводах на наши адреса (Alchemy - ETH/USDT, Helius - SOL)
+ALCHEMY_SIGNING_KEY = os.getenv('ALCHEMY_SIGNING_KEY', '')
+HELIUS_WEBHOOK_SECRET = os.getenv('HELIUS_WEBHOOK_SECRET', '')
+CHAIN_WEBHOOKS_ENABLED = bool(ALCHEMY_SIGNING_KEY or HELIUS_WEBHOOK_SECRET)
+
+# Автоматическая проверка криптоплатежей (JobQueue)
+# С push-уведомлениями опрос остается редкой сверкой (PAYMENT_RECONCILE_INTERVAL)
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', 900))
+PAYMENT_SCAN_INTERVAL = int(os.getenv('PAYMENT_SCAN_INTERVAL', PAYMENT_RECONCILE_INTERVAL if CHAIN_WEBHOOKS_ENABLED else 60))
+PAYMENT_SCAN_MAX_INTERVAL = max(PAYMENT_SCAN_INTERVAL, int(os.getenv('PAYMENT_SCAN_MAX_INTERVAL', 600)))
+PAYMENT_SCAN_JITTER = int(os.getenv('PAYMENT_SCAN_JITTER', 10))
+PAYMENT_SCAN_CONCURRENCY = int(os.getenv('PAYMENT_SCAN_CONCURRENCY', 3))
+payment_scan_lock = asyncio.Lock()
+payment_scan_state = {'interval': PAYMENT_SCAN_INTERVAL, 'next_run': 0.0}
+
+# Event loop бота: Flask-маршруты передают в него корутины
+bot_loop = None
+
 
 # Создаем Flask приложение
 app = Flask(__name__)
 
 
 # Функции для работы с базой данных
-def get_user_wallet(user_id):
+async def get_user_wallet(user_id):
     """Получить кошелек пользователя через Supabase"""
+    # Баланс из LRU-кэша (обновляется при каждом изменении кошелька)
+    cached_balance = wallet_cache.get(user_id)
+    if cached_balance is not None:
+        return cached_balance
+
     try:
-        wallet_data = _get_user_wallet_data(user_id)
-        if wallet_data:
-            return float(wallet_data["balance"])
-        else:
-            # Создаем кошелек если его нет
-            wallet = get_or_create_wallet(user_id)
-            if wallet:
-                return float(wallet.get("balance", 0.0))
-            return 0.0
+        # Обычно кошелек уже есть - только чтение; upsert (один запрос) - при первом обращении
+        wallet = await _get_user_wallet_data(user_id)
+        if wallet is None:
+            wallet = await get_or_create_wallet(user_id)
+        if wallet:
+            return float(wallet.get("balance", 0.0))
+        return 0.0
     except Exception as e:
         logger.error(f"Ошибка получения кошелька: {e}")
         return 0.0
 
 
 # Основные команды бота
+async def rate_limit_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: отсекает запросы сверх лимита до остальных обработчиков"""
+    user = update.effective_user
+    if not user or user.id in ADMIN_IDS:
+        return
+
+    allowed, retry_after = await rate_limiter.hit(user.id)
+    if allowed:
+        return
+
+    if rate_limiter.should_notify(user.id, retry_after):
+        text = f"⏳ Слишком много запросов. Повторите через {max(1, round(retry_after))} сек."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Ошибка уведомления об ограничении {user.id}: {e}")
+    elif update.callback_query:
+        # Без ответа у кнопки остается индикатор загрузки
+        try:
+            await update.callback_query.answer()
+        except Exception:
+            pass
+
+    raise ApplicationHandlerStop
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     # Получаем пользователя из сообщения
@@ -98,65 +178,26 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    user_id = user.id
 
     # Получаем баланс кошелька
-    balance = get_user_wallet(user_id)
-
-    welcome_text = f"""
-🤖 Добро пожаловать в SPACE PAY!
-
-👤 Пользователь: {user.first_name}
-💰 Баланс кошелька: {balance:.2f} USD
-
-Выберите действие:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("🛒 Каталог услуг", callback_data="catalog")],
-        [InlineKeyboardButton("💰 Мой кошелек", callback_data="wallet")],
-        [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")],
-        [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-    ]
-
-    if user_id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("🔧 Админ панель", callback_data="admin")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    balance = await get_user_wallet(user.id)
 
     # Отправляем новое сообщение
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup)
-
-
-help_text = """
-❓ Справка по использованию бота:
-
-📋 Основные команды:
-/start - Главное меню
-/menu - Каталог услуг
-/orders - Мои заказы
-/help - Эта справка
-/check_payment - Проверить платеж (админы)
+    await update.message.reply_text(
+        WELCOME_TEMPLATE.format(first_name=user.first_name, balance=balance),
+        reply_markup=main_menu_keyboard(user.id)
+    )
 
-💳 Доступные услуги:
-• Подписки на сервисы
-• Переводы на карты
-• Другие услуги
 
-💰 Оплата:
-• Внутренний кошелек
-• Банковские карты
-• Криптовалюты
-
-📞 Поддержка:
-• Оператор: @myspacehelper
-"""
+def main_menu_keyboard(user_id):
+    """Клавиатура главного меню (с админ панелью для администраторов)"""
+    return ADMIN_MAIN_MENU_KEYBOARD if user_id in ADMIN_IDS else MAIN_MENU_KEYBOARD
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
 
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
 
 
 async def check_payment_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -175,31 +216,28 @@ async def check_payment_command(update: Update, context: ContextTypes.DEFAULT_TY
         order_id = int(context.args[0])
 
         # Получаем информацию о заказе через Supabase
-        order = get_order_by_id(order_id)
+        order = await get_order_by_id(order_id)
 
         if not order:
             await update.message.reply_text(f"❌ Заказ {order_id} не найден")
             return
 
-        user_id_order = order["user_id"]
-        service_type = order["service_type"]
-        amount = order["amount"]
-        status = order["status"]
-        description = order["description"]
-
-        if not service_type.startswith('deposit_crypto_'):
+        if not order["service_type"].startswith('deposit_crypto_'):
             await update.message.reply_text("❌ Этот заказ не является криптопополнением")
             return
 
-        currency = service_type.replace('deposit_crypto_', '')
-
         # Запускаем проверку платежа
         await update.message.reply_text(f"🔍 Проверяю платеж для заказа {order_id}...")
 
-        # Создаем задачу для фоновой проверки
-        asyncio.create_task(check_payment_background(order_id, currency, amount, user_id_order))
+        # Внеочередная проверка всех ожидающих заказов (не пересекается с плановой)
+        reset_payment_scan_backoff()
+        if await run_payment_scan() is None:
+            await update.message.reply_text("⏳ Проверка платежей уже выполняется, повторите команду позже")
+            return
 
-        await update.message.reply_text(f"✅ Проверка платежа запущена для заказа {order_id}")
+        order = await get_order_by_id(order_id)
+        status = order["status"] if order else "неизвестен"
+        await update.message.reply_text(f"✅ Проверка завершена, статус заказа {order_id}: {status}")
 
     except ValueError:
         await update.message.reply_text("❌ Неверный формат ID заказа")
@@ -231,7 +269,7 @@ async def add_money_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Пополняем кошелек
         logger.info(f"Попытка пополнения кошелька пользователя {target_user_id} на сумму {amount}")
-        success = add_money_to_wallet(target_user_id, amount, f"Ручное пополнение администратором {user_id}")
+        success = await add_money_to_wallet(target_user_id, amount, f"Ручное пополнение администратором {user_id}")
 
         if success:
             # Уведомляем пользователя
@@ -256,87 +294,39 @@ async def add_money_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Обработчики callback
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий кнопок"""
+    """Обработчик нажатий кнопок: маршрут по callback_data (см. callback_router)"""
     query = update.callback_query
     await query.answer()
 
-    user_id = query.from_user.id
-    data = query.data
-
-    if data == "catalog":
-        await show_catalog(query)
-    elif data == "wallet":
-        await show_wallet(query)
-    elif data == "orders":
-        await show_orders(query)
-    elif data == "help":
-        await show_help(query)
-    elif data == "admin" and user_id in ADMIN_IDS:
-        await show_admin_panel(query)
-    elif data.startswith("service_"):
-        await handle_service_selection(query, data)
-    elif data.startswith("back_"):
-        await handle_back_button(query, data)
-    elif data.startswith("order_"):
-        await handle_order_selection(query, data)
-    elif data.startswith("wallet_"):
-        await handle_wallet_action(query, data)
-    elif data.startswith("admin_"):
-        await handle_admin_action(query, data)
-    elif data.startswith("deposit_"):
-        await handle_deposit_action(query, data)
-    elif data.startswith("crypto_deposit_"):
-        await handle_crypto_deposit_selection(query, data)
+    if not await callback_router.dispatch(query):
+        await query.edit_message_text(
+            "⌛ Эта кнопка устарела. Откройте меню заново.",
+            reply_markup=back_keyboard("back_main")
+        )
 
 
+@callback_router.route("catalog")
+@callback_router.route("back_catalog")
 async def show_catalog(query):
     """Показать каталог услуг"""
-    catalog_text = """
-🛒 Каталог услуг
-
-Выберите категорию:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("💳 Оплата зарубежной картой", callback_data="service_payment")],
-        # заменить на переводы --
-        [InlineKeyboardButton("💶 Перевод на счёт", callback_data="service_transfers")],
-        [InlineKeyboardButton("🔧 Другие сервисы", callback_data="service_other_services")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(catalog_text, reply_markup=reply_markup)
+    await query.edit_message_text(CATALOG_TEXT, reply_markup=CATALOG_KEYBOARD)
 
 
+@callback_router.route("wallet")
 async def show_wallet(query):
     """Показать кошелек пользователя"""
-    user_id = query.from_user.id
-    balance = get_user_wallet(user_id)
-
-    wallet_text = f"""
-💰 Мой кошелек
-
-💵 Баланс: {balance:.2f} USD
-
-Выберите действие:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("💳 Пополнить", callback_data="wallet_deposit")],
-        [InlineKeyboardButton("📊 История", callback_data="wallet_history")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(wallet_text, reply_markup=reply_markup)
+    balance = await get_user_wallet(query.from_user.id)
+    await query.edit_message_text(WALLET_TEMPLATE.format(balance=balance), reply_markup=WALLET_KEYBOARD)
 
 
-async def show_orders(query):
-    """Показать заказы пользователя через Supabase"""
+@callback_router.route("orders")
+@callback_router.route("orders_page:{direction}:{cursor}")
+async def show_orders(query, cursor=None, direction="next"):
+    """Показать заказы пользователя через Supabase (постранично)"""
     user_id = query.from_user.id
     try:
-        orders = get_user_orders(user_id)
+        page = await get_user_orders_page(user_id, cursor, direction, PAGE_SIZE)
+        orders = page['items']
 
         if orders:
             orders_text = "📋 Ваши заказы:\n\n"
@@ -349,171 +339,70 @@ async def show_orders(query):
         else:
             orders_text = "📋 У вас пока нет заказов"
 
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(orders_text, reply_markup=reply_markup)
+        reply_markup = get_page_keyboard("orders_page", page, "back_main")
+        await query.edit_message_text(truncate_message(orders_text), reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка show_orders: {e}")
         await query.edit_message_text("❌ Ошибка получения заказов")
 
 
+@callback_router.route("help")
 async def show_help(query):
     """Показать справку"""
-
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(help_text, reply_markup=reply_markup)
+    await query.edit_message_text(HELP_TEXT, reply_markup=back_keyboard("back_main"))
 
 
+@callback_router.route("admin", admin_only=True)
 async def show_admin_panel(query):
     """Показать админ панель"""
-    admin_text = """
-🔧 Админ панель
-
-Выберите действие:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("📋 Все заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton("💰 Управление кошельками", callback_data="admin_wallets")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(admin_text, reply_markup=reply_markup)
-
-
-async def handle_service_selection(query, data):
-    """Обработка выбора услуги"""
-    service_type = data.replace("service_", "")
-
-    if service_type == "transfers":
-        await show_transfers(query)
-    elif service_type == "payment":
-        await show_payment_services(query)
-    elif service_type == "other_services":
-        await show_other_services(query)
+    await query.edit_message_text(ADMIN_PANEL_TEXT, reply_markup=ADMIN_PANEL_KEYBOARD)
 
 
+@callback_router.route("service_transfers")
 async def show_transfers(query):
     """Показать переводы"""
-    transfers_text = """
-💳 Переводы
-
-Выберите тип перевода:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("🇪🇺 Переводы в EC", callback_data="order_transfer_eu")],
-        [InlineKeyboardButton("🇺🇸 Переводы в США", callback_data="order_transfer_us")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_catalog")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(transfers_text, reply_markup=reply_markup)
+    await query.edit_message_text(TRANSFERS_TEXT, reply_markup=TRANSFERS_KEYBOARD)
 
 
+@callback_router.route("service_other_services")
 async def show_other_services(query):
     """Показать другие сервисы"""
-    other_services_text = """
-🔧 Оплата других сервисов
-
-Выберите услугу:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("🔧 Другие сервисы", callback_data="order_other_services")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_catalog")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(other_services_text, reply_markup=reply_markup)
+    await query.edit_message_text(OTHER_SERVICES_TEXT, reply_markup=OTHER_SERVICES_KEYBOARD)
 
 
+@callback_router.route("service_payment")
 async def show_payment_services(query):
     """Показать услуги оплаты зарубежной картой"""
-    payment_services_text = """
-💳 Оплата любых платежей иностранной картой
-
-Выберите услугу:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("🤖 ChatGPT Plus", callback_data="order_gpt")],
-        [InlineKeyboardButton("🐦 X / Twitter", callback_data="order_twitter")],
-        [InlineKeyboardButton("🔍 Другое", callback_data="order_other_services")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_catalog")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(payment_services_text, reply_markup=reply_markup)
-
-
-async def handle_back_button(query, data):
-    """Обработка кнопки назад"""
-    if data == "back_main":
-        await show_main_menu(query)
-    elif data == "back_catalog":
-        await show_catalog(query)
+    await query.edit_message_text(PAYMENT_SERVICES_TEXT, reply_markup=PAYMENT_SERVICES_KEYBOARD)
 
 
+@callback_router.route("back_main")
 async def show_main_menu(query):
     """Показать главное меню"""
-    user_id = query.from_user.id
     user = query.from_user
 
     # Получаем баланс кошелька
-    balance = get_user_wallet(user_id)
-
-    welcome_text = f"""
-🤖 Добро пожаловать в SPACE PAY!
-
-👤 Пользователь: {user.first_name}
-💰 Баланс кошелька: {balance:.2f} USD
-
-Выберите действие:
-"""
-
-    keyboard = [
-        [InlineKeyboardButton("🛒 Каталог услуг", callback_data="catalog")],
-        [InlineKeyboardButton("💰 Мой кошелек", callback_data="wallet")],
-        [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")],
-        [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-    ]
-
-    if user_id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("🔧 Админ панель", callback_data="admin")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    balance = await get_user_wallet(user.id)
 
     # Редактируем сообщение
-    await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+    await query.edit_message_text(
+        WELCOME_TEMPLATE.format(first_name=user.first_name, balance=balance),
+        reply_markup=main_menu_keyboard(user.id)
+    )
 
 
-async def handle_order_selection(query, data):
+@callback_router.route("order_{service_type}")
+async def handle_order_selection(query, service_type):
     """Обработка выбора заказа"""
-    service_type = data.replace("order_", "")
     user_id = query.from_user.id
 
     # Получаем информацию об услуге
     service_info = get_service_info(service_type)
 
     if not service_info:
-        await query.edit_message_text("❌ Услуга не найдена", reply_markup=get_back_keyboard("back_catalog"))
+        await query.edit_message_text("❌ Услуга не найдена", reply_markup=back_keyboard("back_catalog"))
         return
 
-    # Показываем информацию об услуге и запрашиваем сумму
-    service_text = f"""
-🛒 {service_info['name']}
-
-📝 Описание: {service_info['description']}
-{f"💰 Минимальная сумма: {service_info['min_amount']} USD" if service_info.get('min_amount') is not None else ""}
-{f"💸 Комиссия: {service_info['commission']*100}% USD" if service_info.get('min_amount') is not None else ""}
-
-Введите сумму заказа (в USD):
-"""
-
     # Сохраняем состояние пользователя
     user_states[user_id] = {
         'state': 'waiting_amount',
@@ -521,167 +410,67 @@ async def handle_order_selection(query, data):
         'service_info': service_info
     }
 
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_catalog")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await query.edit_message_text(service_text, reply_markup=reply_markup)
-
-
-async def handle_wallet_action(query, data):
-    """Обработка действий с кошельком"""
-    action = data.replace("wallet_", "")
-
-    if action == "deposit":
-        await show_deposit_options(query)
-    elif action == "history":
-        await show_wallet_history(query)
-
-
-async def handle_admin_action(query, data):
-    """Обработка админ действий"""
-    action = data.replace("admin_", "")
-
-    if action == "orders":
-        await show_all_orders(query)
-    elif action == "wallets":
-        await show_wallets_management(query)
-    elif action == "stats":
-        await show_admin_stats(query)
-
+    # Описание услуги с запросом суммы подготовлено заранее
+    await query.edit_message_text(SERVICE_ORDER_TEXTS[service_type], reply_markup=back_keyboard("back_catalog"))
 
-async def handle_deposit_action(query, data):
-    """Обработка действий пополнения"""
-    action = data.replace("deposit_", "")
 
-    if action == "card":
-        await show_card_deposit(query)
-    elif action == "crypto":
-        await show_crypto_deposit(query)
+@callback_router.payload_route("cd")
+async def handle_crypto_deposit_selection(query, currency, amount):
+    """Обработка выбора криптовалюты для пополнения
 
-
-async def handle_crypto_deposit_selection(query, data):
-    """Обработка выбора криптовалюты для пополнения"""
+    Валюта и сумма хранятся на сервере: callback_router.pack("cd", {...})
+    """
     user_id = query.from_user.id
 
-    # Парсим данные: crypto_deposit_btc_100 -> currency=btc, amount=100
-    # crypto_deposit_usdc_sol_100 -> currency=usdc_sol, amount=100
-    parts = data.split('_')
-    if len(parts) >= 4:
-        if len(parts) == 5 and parts[3] == 'sol':
-            # Для USDC и USDT в сети Solana
-            currency = f"{parts[2]}_{parts[3]}"  # usdc_sol, usdt_sol
-            amount = float(parts[4])  # сумма
-        else:
-            # Для обычных криптовалют
-            currency = parts[2]  # btc, eth, usdt, sol
-            amount = float(parts[3])  # сумма
-
-        # Получаем адрес кошелька и рассчитываем количество криптовалюты
-        wallet_address = "Адрес не настроен"
-        crypto_amount = 0
-
-        # Отладочная информация
-        logger.info(f"crypto_checker: {crypto_checker}")
-        logger.info(f"currency: {currency}")
-        logger.info(f"amount: {amount}")
-
-        if crypto_checker and hasattr(crypto_checker, 'wallets') and currency in crypto_checker.wallets:
-            wallet_address = crypto_checker.wallets[currency]
-            logger.info(f"wallet_address: {wallet_address}")
-            # Рассчитываем количество криптовалюты по текущему курсу
-            try:
-                crypto_amount = crypto_checker.calculate_crypto_amount(amount, currency)
-                logger.info(f"crypto_amount: {crypto_amount}")
-            except Exception as e:
-                logger.error(f"Ошибка расчета количества {currency}: {e}")
-                # Fallback расчет
-                fallback_rates = {
-                    'eth': 3000.0,
-                    'usdt': 1.0,
-                    'sol': 100.0,
-                    'usdc_sol': 1.0,
-                    'usdt_sol': 1.0,
-                }
-                rate = fallback_rates.get(currency, 1.0)
-                crypto_amount = amount / rate if rate > 0 else 0
-                logger.info(f"fallback crypto_amount: {crypto_amount}")
-        else:
-            logger.error(f"crypto_checker не инициализирован или валюта {currency} не найдена")
-            logger.error(f"crypto_checker: {crypto_checker}")
-            logger.error(f"hasattr wallets: {hasattr(crypto_checker, 'wallets') if crypto_checker else False}")
-            if crypto_checker and hasattr(crypto_checker, 'wallets'):
-                logger.error(f"available currencies: {list(crypto_checker.wallets.keys())}")
-
-            # Fallback адреса кошельков
-            fallback_wallets = {
-                'eth': '0x12E450e53E1acD323B95e36636cB4927aC6C17eE',
-                'usdt': '0x12E450e53E1acD323B95e36636cB4927aC6C17eE',
-                'sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq',
-                'usdc_sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq',
-                'usdt_sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq'
-            }
-
-            if currency in fallback_wallets:
-                wallet_address = fallback_wallets[currency]
-                logger.info(f"Используем fallback адрес: {wallet_address}")
-
-                # Fallback расчет криптовалюты
-                fallback_rates = {
-                    'eth': 3000.0,
-                    'usdt': 1.0,
-                    'sol': 100.0,
-                    'usdc_sol': 1.0,
-                    'usdt_sol': 1.0,
-                }
-                rate = fallback_rates.get(currency, 1.0)
-                crypto_amount = amount / rate if rate > 0 else 0
-                logger.info(f"fallback crypto_amount: {crypto_amount}")
-
-        # Получаем текущий курс
-        currency_mapping = {
-            'eth': 'ethereum',
-            'usdt': 'tether',
-            'sol': 'solana',
-            'usdc_sol': 'usd-coin',
-            'usdt_sol': 'tether'
+    # Получаем адрес кошелька
+    wallet_address = "Адрес не настроен"
+    if crypto_checker and currency in crypto_checker.wallets:
+        wallet_address = crypto_checker.wallets[currency]
+    else:
+        # Fallback адреса кошельков (валюты сети Solana, которые не проверяет крипточекер)
+        fallback_wallets = {
+            'eth': '0x12E450e53E1acD323B95e36636cB4927aC6C17eE',
+            'usdt': '0x12E450e53E1acD323B95e36636cB4927aC6C17eE',
+            'sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq',
+            'usdc_sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq',
+            'usdt_sol': '6s8bjsP5K3hvdj3bca4FxW8W6CqqSLH26aufVALTJbBq'
         }
+        wallet_address = fallback_wallets.get(currency, wallet_address)
+
+    # Получаем текущий курс (из кэша крипточекера) и рассчитываем количество криптовалюты
+    coin_id = CURRENCY_COINS.get(currency, currency)
+    price_updated_at = None
+    try:
+        current_price = await crypto_checker.get_crypto_price(coin_id)
+        price_updated_at = crypto_checker.prices_updated_at
+    except Exception as e:
+        logger.error(f"Ошибка получения курса {coin_id}: {e}")
+        current_price = FALLBACK_PRICES.get(coin_id, 1.0)
+        logger.info(f"Используем fallback курс для {coin_id}: {current_price}")
 
-        coin_id = currency_mapping.get(currency, currency)
+    crypto_amount = amount / current_price if current_price > 0 else 0
+    price_time = datetime.fromtimestamp(price_updated_at).strftime('%H:%M:%S') if price_updated_at else "резервный курс"
 
-        # Безопасное получение курса
-        current_price = 0
-        if crypto_checker and hasattr(crypto_checker, 'get_crypto_price'):
-            try:
-                current_price = crypto_checker.get_crypto_price(coin_id)
-            except Exception as e:
-                logger.error(f"Ошибка получения курса {coin_id}: {e}")
-                # Fallback курсы
-                fallback_rates = {
-                    'solana': 100.0,
-                    'ethereum': 3000.0,
-                    'tether': 1.0,
-                    'usd-coin': 1.0,
-                }
-                current_price = fallback_rates.get(coin_id, 1.0)
-        else:
-            logger.error(f"crypto_checker не инициализирован для получения курса")
-            # Fallback курсы
-            fallback_rates = {
-                'solana': 100.0,
-                'ethereum': 3000.0,
-                'tether': 1.0,
-                'usd-coin': 1.0,
-            }
-            current_price = fallback_rates.get(coin_id, 1.0)
-            logger.info(f"Используем fallback курс для {coin_id}: {current_price}")
+    # Создаем заказ на пополнение (вместе с историей статусов, одной транзакцией)
+    order = await create_order(user_id, f'deposit_crypto_{currency}', amount, f"Пополнение {currency.upper()} {amount} USD")
+    if not order:
+        await query.edit_message_text("❌ Ошибка создания заказа. Попробуйте еще раз.")
+        del user_states[user_id]
+        return
+    order_id = order['id']
 
-        crypto_text = f"""
+    # Уникальная сумма оплаты: по ней входящий перевод однозначно сопоставляется с заказом
+    if crypto_checker:
+        crypto_amount = crypto_checker.register_pending_payment(order_id, currency, crypto_amount)
+    reset_payment_scan_backoff()
+
+    crypto_text = f"""
 ₿ **Пополнение {currency.upper()}**
 
 💰 Сумма к оплате: {amount:.2f} USD
 
 📊 **Калькулятор:**
-• Курс {currency.upper()}: ${current_price:.4f}
+• Курс {currency.upper()}: ${current_price:.4f} ({price_time})
 • Количество для оплаты: {crypto_amount:.6f} {currency.upper()}
 
 📝 **Адрес для оплаты:**
@@ -694,34 +483,28 @@ async def handle_crypto_deposit_selection(query, data):
 • При проблемах обращайтесь к @myspacehelper
 
 ⏰ Ожидайте подтверждения платежа...
-        """
+    """
 
-        # Создаем заказ на пополнение
-        order_id = create_order(user_id, f'deposit_crypto_{currency}', amount, f"Пополнение {currency.upper()} {amount} USD")
+    # Запускаем проверку платежа в фоне
+    asyncio.create_task(check_payment_background(order_id, currency, crypto_amount, user_id))
 
-        # Запускаем проверку платежа в фоне
-        asyncio.create_task(check_payment_background(order_id, currency, crypto_amount, user_id))
-
-        keyboard = [
-            [InlineKeyboardButton("💰 Мой кошелек", callback_data="wallet")],
-            [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    keyboard = [
+        [InlineKeyboardButton("💰 Мой кошелек", callback_data="wallet")],
+        [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await query.edit_message_text(crypto_text, reply_markup=reply_markup, parse_mode='Markdown')
-        del user_states[user_id]
-    else:
-        await query.edit_message_text("❌ Ошибка обработки выбора криптовалюты")
-        del user_states[user_id]
+    await query.edit_message_text(crypto_text, reply_markup=reply_markup, parse_mode='Markdown')
+    del user_states[user_id]
 
 
 async def check_payment_background(order_id, currency, expected_amount, user_id):
-    """Фоновая проверка платежа (отключена для предотвращения постоянных запросов)"""
+    """Уведомить администратора о новом заказе (платеж проверяется задачей payment_scan_job)"""
 
     try:
-        logger.info(f"Заказ {order_id} создан для ручной проверки платежа, валюта: {currency}")
+        logger.info(f"Заказ {order_id} создан, валюта: {currency}")
 
-        # Уведомляем администратора о необходимости ручной проверки
+        # Уведомляем администратора о новом заказе
         try:
             await bot.send_message(
                 chat_id=ADMIN_ID,
@@ -730,80 +513,51 @@ async def check_payment_background(order_id, currency, expected_amount, user_id)
                      f"💰 Валюта: {currency.upper()}\n"
                      f"💵 Ожидаемая сумма: {expected_amount}\n"
                      f"👤 Пользователь: {user_id}\n\n"
-                     f"⚠️ Требуется ручная проверка платежа!\n"
-                     f"Используйте команду: /check_payment {order_id}"
+                     f"⏱ Платеж проверяется автоматически каждые {PAYMENT_SCAN_INTERVAL}с\n"
+                     f"Внеочередная проверка: /check_payment {order_id}"
             )
         except Exception as e:
             logger.error(f"Ошибка уведомления администратора: {e}")
 
-        logger.info(f"Заказ {order_id} ожидает ручной проверки администратором")
-
     except Exception as e:
         logger.error(f"Ошибка обработки заказа: {e}")
 
 
 def get_service_info(service_type):
     """Получить информацию об услуге"""
-    services = {
-        'transfer_eu': {
-            'name': 'Перевод на европейские карты',
-            'description': 'Перевод средств на карты европейских банков',
-            'min_amount': 10,
-            'commission': 0.08
-        },
-        'transfer_us': {
-            'name': 'Перевод на американские карты',
-            'description': 'Перевод средств на карты американских банков',
-            'min_amount': 10,
-            'commission': 0.08
-        },
-        'gpt': {
-            'name': 'GPT',
-            'description': 'Оплата подписки ChatGPT Plus (только Плюс)',
-            'min_amount': 22.4,
-            'commission': 0.08
-        },
-        'twitter': {
-            'name': 'Twitter/X',
-            'description': 'Подписки на Twitter/X (Blue, Premium, Verified)',
-            'min_amount': 8,
-            'commission': 0.08
-        },
-        'other_services': {
-            'name': 'Оплата других сервисов',
-            'description': 'Оплата любых других сервисов и услуг',
-            'min_amount': 10,
-            'commission': 0.08
-        }
-    }
+    return SERVICES.get(service_type)
 
-    return services.get(service_type)
 
+def get_page_keyboard(prefix, page, back_action):
+    """Получить клавиатуру с навигацией по страницам и кнопкой назад
 
-def get_back_keyboard(back_action):
-    """Получить клавиатуру с кнопкой назад"""
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=back_action)]]
-    return InlineKeyboardMarkup(keyboard)
+    callback_data кнопок: <prefix>:<prev|next>:<курсор>
+    """
+    nav_row = []
+    if page['prev_cursor']:
+        nav_row.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"{prefix}:prev:{page['prev_cursor']}"))
+    if page['next_cursor']:
+        nav_row.append(InlineKeyboardButton("Старше ➡️", callback_data=f"{prefix}:next:{page['next_cursor']}"))
 
+    keyboard = [nav_row] if nav_row else []
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=back_action)])
+    return InlineKeyboardMarkup(keyboard)
 
-async def show_deposit_options(query):
-    """Показать варианты пополнения"""
-    deposit_text = """
-💳 Пополнение кошелька
 
-Выберите способ пополнения:
-"""
+def truncate_message(text):
+    """Обрезать текст до лимита Telegram"""
+    if len(text) <= MAX_MESSAGE_LENGTH:
+        return text
+    return text[:MAX_MESSAGE_LENGTH - 1] + "…"
 
-    keyboard = [
-        [InlineKeyboardButton("💳 Перевод рублей на карту", callback_data="deposit_card")],
-        [InlineKeyboardButton("₿ Криптовалюта", callback_data="deposit_crypto")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="wallet")]
-    ]
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(deposit_text, reply_markup=reply_markup)
+@callback_router.route("wallet_deposit")
+async def show_deposit_options(query):
+    """Показать варианты пополнения"""
+    await query.edit_message_text(DEPOSIT_OPTIONS_TEXT, reply_markup=DEPOSIT_OPTIONS_KEYBOARD)
 
 
+@callback_router.route("deposit_card")
 async def show_card_deposit(query):
     """Показать пополнение картой"""
     user_id = query.from_user.id
@@ -832,6 +586,7 @@ async def show_card_deposit(query):
     await query.edit_message_text(card_text, reply_markup=reply_markup)
 
 
+@callback_router.route("deposit_crypto")
 async def show_crypto_deposit(query):
     """Показать пополнение криптовалютой"""
     user_id = query.from_user.id
@@ -868,11 +623,14 @@ async def show_crypto_deposit(query):
     await query.edit_message_text(crypto_text, reply_markup=reply_markup)
 
 
-async def show_wallet_history(query):
-    """Показать историю кошелька через Supabase"""
+@callback_router.route("wallet_history")
+@callback_router.route("wallet_history_page:{direction}:{cursor}")
+async def show_wallet_history(query, cursor=None, direction="next"):
+    """Показать историю кошелька через Supabase (постранично)"""
     user_id = query.from_user.id
     try:
-        transactions = get_user_transactions(user_id)
+        page = await get_user_transactions_page(user_id, cursor, direction, PAGE_SIZE)
+        transactions = page['items']
 
         if transactions:
             history_text = "📊 История транзакций:\n\n"
@@ -885,19 +643,21 @@ async def show_wallet_history(query):
         else:
             history_text = "📊 История транзакций пуста"
 
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="wallet")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(history_text, reply_markup=reply_markup)
+        reply_markup = get_page_keyboard("wallet_history_page", page, "wallet")
+        await query.edit_message_text(truncate_message(history_text), reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка show_wallet_history: {e}")
         await query.edit_message_text("❌ Ошибка получения истории")
 
 
-async def show_all_orders(query):
-    """Показать все заказы (админ) через Supabase"""
+@callback_router.route("admin_orders", admin_only=True)
+@callback_router.route("admin_orders_page:{direction}:{cursor}", admin_only=True)
+async def show_all_orders(query, cursor=None, direction="next"):
+    """Показать все заказы (админ) через Supabase (постранично)"""
     try:
-        # Получаем заказы через функцию
-        orders = get_all_orders(limit=20)
+        # Получаем одну страницу заказов
+        page = await get_all_orders_page(cursor, direction, PAGE_SIZE)
+        orders = page['items']
 
         if orders:
             orders_text = "📋 Все заказы:\n\n"
@@ -921,20 +681,20 @@ async def show_all_orders(query):
         else:
             orders_text = "📋 Заказов пока нет"
 
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = get_page_keyboard("admin_orders_page", page, "admin")
 
-        await query.edit_message_text(orders_text, reply_markup=reply_markup)
+        await query.edit_message_text(truncate_message(orders_text), reply_markup=reply_markup)
 
     except Exception as e:
         logger.error(f"Ошибка получения заказов: {e}")
         await query.edit_message_text("❌ Ошибка получения заказов")
 
 
+@callback_router.route("admin_wallets", admin_only=True)
 async def show_wallets_management(query):
     """Показать управление кошельками (админ) через Supabase"""
     try:
-        wallets = get_top_wallets()
+        wallets = await get_top_wallets()
 
         if wallets:
             wallets_text = "💰 Управление кошельками:\n\n"
@@ -959,11 +719,12 @@ async def show_wallets_management(query):
         await query.edit_message_text("❌ Ошибка получения кошельков")
 
 
+@callback_router.route("admin_stats", admin_only=True)
 async def show_admin_stats(query):
     """Показать статистику (админ) через Supabase"""
     try:
-        # Получаем статистику через функцию
-        stats = get_stats()
+        # Получаем статистику из кэша (обновляется в фоне)
+        stats = await stats_cache.aget()
         users_count = stats["users_count"]
         orders_count = stats["orders_count"]
         total_amount = stats["total_amount"]
@@ -1036,70 +797,50 @@ async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE
 
             if crypto_checker:
                 wallet_address = crypto_checker.wallets.get(currency, 'Адрес не настроен')
+                total = amount + (amount * service_info['commission'])
+
+                # Количество криптовалюты по текущему курсу (из кэша крипточекера)
+                coin_id = CURRENCY_COINS.get(currency, currency)
+                try:
+                    current_price = await crypto_checker.get_crypto_price(coin_id)
+                except Exception as e:
+                    logger.error(f"Ошибка получения курса {coin_id}: {e}")
+                    current_price = FALLBACK_PRICES.get(coin_id, 1.0)
+                    logger.info(f"Используем fallback курс для {coin_id}: {current_price}")
+                crypto_amount = total / current_price if current_price > 0 else 0
 
-                crypto_text = f"""
+                # Создаем заказ без списания средств
+                order = await create_order(user_id, state['service_type'], amount, f"Криптоплатеж {currency.upper()}")
+
+                if order:
+                    order_id = order['id']
+                    # Уникальная сумма оплаты: по ней входящий перевод однозначно сопоставляется с заказом,
+                    # сам платеж подтверждает задача payment_scan_job
+                    crypto_amount = crypto_checker.register_pending_payment(order_id, currency, crypto_amount)
+                    reset_payment_scan_backoff()
+
+                    crypto_text = f"""
 💳 **Криптоплатеж {currency.upper()}**
 
 💰 Сумма: {amount:.2f} USD
 🛒 Услуга: {service_info['name']}
 💸 Комиссия: {amount * service_info['commission']:.2f} USD
-💳 Итого: {amount + (amount * service_info['commission']):.2f} USD
+💳 Итого: {total:.2f} USD
+🆔 Заказ: #{order_id}
+
+📊 Количество для оплаты: {crypto_amount:.6f} {currency.upper()}
 
 📝 **Адрес для оплаты:**
 `{wallet_address}`
 
 ⚠️ **Важно:**
-• Отправьте точную сумму в {currency.upper()}
+• Отправьте точную сумму: {crypto_amount:.6f} {currency.upper()}
 • Платеж будет проверен автоматически
 • После подтверждения карта будет выдана
 
 ⏰ Ожидайте подтверждения платежа...
 """
 
-                # Создаем заказ без списания средств
-                order_id = create_order(user_id, state['service_type'], amount, f"Криптоплатеж {currency.upper()}")
-
-                if order_id:
-                    # Проверяем платеж сразу после создания заказа
-                    try:
-                        result = crypto_checker.check_payment(currency, amount, order_id)
-                        if result['success']:
-                            # Платеж найден, обрабатываем
-                            if crypto_checker.process_payment(result):
-                                # Обновляем статус заказа
-                                _update_order_status_in_supabase(order_id, 'completed', ADMIN_ID, f'Криптоплатеж подтвержден: {result["amount"]} {result["currency"]}')
-
-                                # Выдаем карту
-                                card_info = auto_issue_card(state['service_type'], amount, user_id)
-
-                                success_text = f"""
-✅ **Платеж подтвержден!**
-
-💰 Сумма: {result['amount']} {result['currency'].upper()}
-🆔 Заказ: #{order_id}
-📅 Время: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}
-
-🎫 **Ваша карта:**
-Номер: {card_info['card_number']}
-Срок: {card_info['expiry']}
-CVV: {card_info['cvv']}
-
-Спасибо за покупку! 🎉
-                                """
-
-                                keyboard = [
-                                    [InlineKeyboardButton("🛒 Новый заказ", callback_data="catalog")],
-                                    [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")]
-                                ]
-                                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                                await update.message.reply_text(success_text, reply_markup=reply_markup, parse_mode='Markdown')
-                                del user_states[user_id]
-                                return
-                    except Exception as e:
-                        logger.error(f"Ошибка проверки криптоплатежа: {e}")
-
-                    # Если платеж не найден, показываем адрес для оплаты
                     keyboard = [
                         [InlineKeyboardButton("🛒 Новый заказ", callback_data="catalog")],
                         [InlineKeyboardButton("📋 Мои заказы", callback_data="orders")]
@@ -1116,7 +857,7 @@ CVV: {card_info['cvv']}
             return
 
         # Для обычных платежей проверяем баланс
-        user_balance = get_user_wallet(user_id)
+        user_balance = await get_user_wallet(user_id)
         total_cost = amount + (amount * service_info['commission'])
 
         if user_balance < total_cost:
@@ -1130,11 +871,12 @@ CVV: {card_info['cvv']}
             return
 
         # Создаем заказ и списываем средства
-        order_id = create_order(user_id, state['service_type'], amount, f"Заказ {service_info['name']}")
+        order = await create_order(user_id, state['service_type'], amount, f"Заказ {service_info['name']}")
 
-        if order_id:
+        if order:
+            order_id = order['id']
             # Списываем средства
-            success = update_wallet_balance(user_id, -total_cost, 'purchase', f'Покупка {service_info["name"]}')
+            success = await update_wallet_balance(user_id, -total_cost, 'purchase', f'Покупка {service_info["name"]}')
 
             if success:
                 # Выдаем карту
@@ -1218,7 +960,11 @@ async def handle_deposit_amount_input(update: Update, context: ContextTypes.DEFA
             """
 
             # Создаем заказ на пополнение
-            order_id = create_order(user_id, 'deposit_card', amount, f"Пополнение картой {amount} USD")
+            order = await create_order(user_id, 'deposit_card', amount, f"Пополнение картой {amount} USD")
+            if not order:
+                await update.message.reply_text("❌ Ошибка создания заказа. Попробуйте еще раз.")
+                del user_states[user_id]
+                return
 
             keyboard = [
                 [InlineKeyboardButton("💰 Мой кошелек", callback_data="wallet")],
@@ -1241,11 +987,11 @@ async def handle_deposit_amount_input(update: Update, context: ContextTypes.DEFA
             """
 
             keyboard = [
-                [InlineKeyboardButton("Ethereum (ETH)", callback_data=f"crypto_deposit_eth_{amount}")],
-                [InlineKeyboardButton("USDT (ERC-20)", callback_data=f"crypto_deposit_usdt_{amount}")],
-                [InlineKeyboardButton("Solana (SOL)", callback_data=f"crypto_deposit_sol_{amount}")],
-                [InlineKeyboardButton("USDC (Solana)", callback_data=f"crypto_deposit_usdc_sol_{amount}")],
-                [InlineKeyboardButton("USDT (Solana)", callback_data=f"crypto_deposit_usdt_sol_{amount}")],
+                [InlineKeyboardButton("Ethereum (ETH)", callback_data=callback_router.pack("cd", {'currency': 'eth', 'amount': amount}, user_id))],
+                [InlineKeyboardButton("USDT (ERC-20)", callback_data=callback_router.pack("cd", {'currency': 'usdt', 'amount': amount}, user_id))],
+                [InlineKeyboardButton("Solana (SOL)", callback_data=callback_router.pack("cd", {'currency': 'sol', 'amount': amount}, user_id))],
+                [InlineKeyboardButton("USDC (Solana)", callback_data=callback_router.pack("cd", {'currency': 'usdc_sol', 'amount': amount}, user_id))],
+                [InlineKeyboardButton("USDT (Solana)", callback_data=callback_router.pack("cd", {'currency': 'usdt_sol', 'amount': amount}, user_id))],
                 [InlineKeyboardButton("🔙 Назад", callback_data="wallet_deposit")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1267,43 +1013,97 @@ async def handle_deposit_amount_input(update: Update, context: ContextTypes.DEFA
 
 
 # Функция для проверки криптоплатежей
-async def check_crypto_payments():
-    """Проверка криптоплатежей через Supabase в фоновом режиме"""
+def get_order_currency(service_type):
+    """Валюта криптозаказа: deposit_crypto_eth -> eth, crypto_sol -> sol"""
+    if service_type.startswith('deposit_crypto_'):
+        return service_type.replace('deposit_crypto_', '', 1)
+    return service_type.replace('crypto_', '', 1)
+
+
+def to_payment_orders(pending_orders):
+    """Заказы Supabase в формате крипточекера: {'order_id', 'currency', 'expected_amount'}"""
+    return [
+        {
+            'order_id': order["id"],
+            'currency': get_order_currency(order["service_type"]),
+            'expected_amount': order["amount"]
+        }
+        for order in pending_orders
+    ]
 
-    if not crypto_checker:
-        logger.warning("Крипточекер не инициализирован")
-        return
 
+async def rollback_crypto_payment(result, order_id):
+    """Вернуть заказ в ожидание после неудачного зачисления, чтобы платеж обработался повторно"""
     try:
-        # Получаем все pending заказы с криптоплатежами через Supabase
-        pending_orders = get_pending_crypto_orders()
-
-        for order in pending_orders:
-            order_id = order["id"]
-            user_id = order["user_id"]
-            service_type = order["service_type"]
-            amount = order["amount"]
-
-            currency = service_type.replace("crypto_", "")
-
-            # Проверяем платеж
-            result = crypto_checker.check_payment(currency, amount, order_id)
-
-            if result["success"] and crypto_checker.process_payment(result):
-                # Обновляем статус заказа через Supabase
-                update_order_status(
-                    order_id,
-                    "completed",
-                    ADMIN_ID,
-                    f'Криптоплатеж подтвержден: {result["amount"]} {result["currency"]}'
-                )
+        reverted = await update_order_status(order_id, "pending", ADMIN_ID, "Ошибка зачисления, повторная обработка")
+    except Exception as e:
+        reverted = False
+        logger.error(f"Ошибка возврата заказа {order_id} в ожидание: {e}")
+    if reverted:
+        logger.error(f"❌ Ошибка зачисления по заказу {order_id}, платеж будет обработан повторно")
+        crypto_checker.release_payment(result)
+    else:
+        logger.error(f"❌ Заказ {order_id} подтвержден без зачисления, транзакция {result['tx_hash']} требует ручной проверки")
+
+
+async def complete_crypto_payments(results, orders_by_id):
+    """Подтвердить найденные платежи: статус заказа, зачисление или карта, уведомление
+
+    Транзакция сначала засчитывается за заказом (условной отметкой - один
+    перевод не может быть засчитан дважды), затем заказ переводится в
+    completed и только после этого зачисляются деньги. Если шаг явно не
+    удался, заказ и транзакция возвращаются в ожидание и следующая проверка
+    повторит обработку. При неизвестном исходе (исключение) отметка
+    остается, чтобы не зачислить дважды, - заказ проверяет администратор.
+    """
+    for result in results:
+        order = orders_by_id[result["order_id"]]
+        order_id = order["id"]
+        user_id = order["user_id"]
+        service_type = order["service_type"]
+        amount = order["amount"]
 
-                # Выдаем карту
-                card_info = auto_issue_card(service_type, amount, user_id)
+        if not crypto_checker.process_payment(result):
+            continue
 
-                # Уведомляем пользователя
-                try:
-                    success_text = f"""
+        # Обновляем статус заказа через Supabase
+        try:
+            completed = await update_order_status(
+                order_id,
+                "completed",
+                ADMIN_ID,
+                f'Криптоплатеж подтвержден: {result["amount"]} {result["currency"]}'
+            )
+        except Exception as e:
+            logger.error(f"❌ Исход подтверждения заказа {order_id} неизвестен, транзакция {result['tx_hash']} требует ручной проверки: {e}")
+            continue
+        if not completed:
+            logger.error(f"❌ Не удалось подтвердить заказ {order_id}, платеж будет обработан повторно")
+            crypto_checker.release_payment(result)
+            continue
+
+        if service_type.startswith('deposit_crypto_'):
+            # Пополнение кошелька
+            try:
+                credited = await add_money_to_wallet(user_id, amount, f"Пополнение {result['currency'].upper()}, заказ #{order_id}")
+            except Exception as e:
+                logger.error(f"❌ Исход зачисления по заказу {order_id} неизвестен, требуется ручная проверка: {e}")
+                continue
+            if not credited:
+                await rollback_crypto_payment(result, order_id)
+                continue
+            success_text = f"""
+✅ **Платеж подтвержден!**
+
+💰 Получено: {result['amount']} {result['currency'].upper()}
+💵 Зачислено: {amount:.2f} USD
+🆔 Заказ: #{order_id}
+📅 Время: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}
+            """
+        else:
+            # Выдаем карту
+            card_info = auto_issue_card(service_type, amount, user_id)
+            success_text = f"""
 ✅ **Платеж подтвержден!**
 
 💰 Сумма: {result['amount']} {result['currency'].upper()}
@@ -1316,21 +1116,121 @@ async def check_crypto_payments():
 CVV: {card_info['cvv']}
 
 Спасибо за покупку! 🎉
-                    """
+            """
+
+        crypto_checker.complete_payment(result)
+
+        # Уведомляем пользователя
+        try:
+            await application.bot.send_message(
+                chat_id=user_id,
+                text=success_text,
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Ошибка уведомления пользователя {user_id}: {e}")
+
+        logger.info(f"Заказ {order_id} обработан успешно")
 
-                    await application.bot.send_message(
-                        chat_id=user_id,
-                        text=success_text,
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления пользователя {user_id}: {e}")
 
-                logger.info(f"Заказ {order_id} обработан успешно")
+async def check_crypto_payments():
+    """Проверка криптоплатежей через Supabase в фоновом режиме
+
+    Возвращает количество заказов, ожидающих оплаты в пределах окна
+    (для адаптивного интервала). Брошенные заказы с истекшим окном
+    сопоставить уже нельзя, поэтому они не учитываются и сети по ним
+    не опрашиваются.
+    """
+
+    if not crypto_checker:
+        logger.warning("Крипточекер не инициализирован")
+        return 0
+
+    awaiting = []
+    try:
+        # Получаем все pending заказы с криптоплатежами через Supabase
+        pending_orders = await get_pending_crypto_orders()
+        awaiting = crypto_checker.awaiting_orders(to_payment_orders(pending_orders))
+        if not awaiting:
+            return 0
+
+        # Все сети опрашиваются один раз и параллельно, сопоставление - в памяти
+        results = await crypto_checker.scan_pending_orders(awaiting, max_concurrency=PAYMENT_SCAN_CONCURRENCY)
+        await complete_crypto_payments(results, {order["id"]: order for order in pending_orders})
+        # Курсоры сканирования сохраняются только после обработки найденных платежей
+        crypto_checker.commit_scan_cursors()
 
     except Exception as e:
         logger.error(f"Ошибка проверки криптоплатежей: {e}")
 
+    return len(awaiting)
+
+
+async def process_chain_activity(transfers):
+    """Обработать переводы из push-уведомления (Alchemy/Helius)
+
+    Выполняется под тем же замком, что и опрос, поэтому один перевод
+    не будет засчитан дважды.
+    """
+    async with payment_scan_lock:
+        try:
+            pending_orders = await get_pending_crypto_orders()
+            results = crypto_checker.ingest_transfers(transfers, to_payment_orders(pending_orders))
+            await complete_crypto_payments(results, {order["id"]: order for order in pending_orders})
+            logger.info(f"📬 Уведомление сети: переводов {len(transfers)}, подтверждено платежей {len(results)}")
+        except Exception as e:
+            logger.error(f"Ошибка обработки уведомления сети: {e}")
+
+
+async def run_payment_scan():
+    """Запустить проверку платежей, если предыдущая еще не завершилась
+
+    Возвращает количество заказов в окне оплаты или None, если проверка пропущена.
+    """
+    if payment_scan_lock.locked():
+        logger.info("Предыдущая проверка платежей еще выполняется, пропускаем")
+        return None
+
+    async with payment_scan_lock:
+        return await check_crypto_payments()
+
+
+async def price_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача JobQueue: обновление кэша курсов в фоне"""
+    try:
+        await crypto_checker.refresh_prices()
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления курсов: {e}")
+
+
+def reset_payment_scan_backoff():
+    """Вернуть базовый интервал проверки (появился новый заказ)"""
+    payment_scan_state['interval'] = PAYMENT_SCAN_INTERVAL
+    payment_scan_state['next_run'] = 0.0
+
+
+async def payment_scan_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача JobQueue: автоматическая проверка криптоплатежей
+
+    Задача срабатывает каждые PAYMENT_SCAN_INTERVAL секунд (с джиттером).
+    Если заказов в окне оплаты нет, интервал удваивается до PAYMENT_SCAN_MAX_INTERVAL,
+    лишние срабатывания пропускаются.
+    """
+    now = time.monotonic()
+    if now < payment_scan_state['next_run']:
+        return
+
+    pending_count = await run_payment_scan()
+    if pending_count is None:
+        return
+
+    if pending_count:
+        payment_scan_state['interval'] = PAYMENT_SCAN_INTERVAL
+        payment_scan_state['next_run'] = 0.0
+    else:
+        payment_scan_state['interval'] = min(payment_scan_state['interval'] * 2, PAYMENT_SCAN_MAX_INTERVAL)
+        payment_scan_state['next_run'] = now + payment_scan_state['interval']
+
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
@@ -1404,14 +1304,26 @@ def health():
 @app.route('/stats')
 def stats():
     try:
-        stats_data = get_stats()
-        return jsonify({
+        with_breakdown = request.args.get("breakdown", "").lower() in ("1", "true", "yes")
+        stats_data = stats_cache.get(with_breakdown=with_breakdown)
+        response = {
             "users_count": stats_data["users_count"],
             "orders_count": stats_data["orders_count"],
             "total_amount": stats_data["total_amount"],
             "total_balance": stats_data["total_balance"],
-            "timestamp": datetime.now().isoformat()
-        })
+            "timestamp": datetime.now().isoformat(),
+            "cache": stats_data["cache"]
+        }
+        if with_breakdown:
+            response["by_status"] = stats_data.get("by_status", {})
+            response["by_service_type"] = stats_data.get("by_service_type", {})
+        if crypto_checker:
+            response["processed_tx_cache"] = crypto_checker.processed_cache_stats()
+            response["chain_api"] = crypto_checker.http_stats()
+        response["rate_limiter"] = rate_limiter.stats()
+        response["conversation_states"] = user_states.stats()
+        response["callback_routes"] = callback_router.stats()
+        return jsonify(response)
     except Exception as e:
         logger.error(f"Ошибка получения /stats: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1419,19 +1331,61 @@ def stats():
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    if request.method == "POST":
-        try:
-            update = Update.de_json(request.get_json(force=True), application.bot)
-            asyncio.run(application.process_update(update))
-            return jsonify({"status": "ok"}), 200
-        except Exception as e:
-            logger.error(f"Ошибка обработки вебхука: {e}")
-            return jsonify({"error": str(e)}), 500
+    """Обновления от Telegram: в очередь Application, ответ - сразу"""
+    if TELEGRAM_WEBHOOK_SECRET and not hmac.compare_digest(
+            TELEGRAM_WEBHOOK_SECRET, request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+        return jsonify({"error": "invalid secret token"}), 403
+
+    if bot_loop is None:
+        return jsonify({"error": "bot not ready"}), 503
+
+    try:
+        update = Update.de_json(request.get_json(force=True), application.bot)
+        bot_loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+        return jsonify({"status": "ok"}), 200
+    except Exception as e:
+        logger.error(f"Ошибка обработки вебхука: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def verify_chain_webhook(provider, body, headers):
+    """Проверить подлинность push-уведомления провайдера
+
+    Alchemy подписывает тело HMAC-SHA256 ключом вебхука (X-Alchemy-Signature),
+    Helius передает заданный при создании вебхука секрет в Authorization.
+    """
+    if provider == 'alchemy' and ALCHEMY_SIGNING_KEY:
+        expected = hmac.new(ALCHEMY_SIGNING_KEY.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, headers.get('X-Alchemy-Signature', ''))
+    if provider == 'helius' and HELIUS_WEBHOOK_SECRET:
+        return hmac.compare_digest(HELIUS_WEBHOOK_SECRET, headers.get('Authorization', ''))
+    return False
+
+
+@app.route('/chain-webhook/<provider>', methods=['POST'])
+def chain_webhook(provider):
+    """Push-уведомления о переводах на адреса приема платежей"""
+    if not verify_chain_webhook(provider, request.get_data(), request.headers):
+        logger.warning(f"Отклонено уведомление {provider}: неверная подпись")
+        return jsonify({"error": "invalid signature"}), 401
+
+    if not crypto_checker or bot_loop is None:
+        return jsonify({"error": "bot not ready"}), 503
+
+    try:
+        transfers = crypto_checker.parse_webhook_transfers(provider, request.get_json(force=True))
+    except Exception as e:
+        logger.error(f"Ошибка разбора уведомления {provider}: {e}")
+        return jsonify({"error": str(e)}), 400
+
+    if transfers:
+        asyncio.run_coroutine_threadsafe(process_chain_activity(transfers), bot_loop)
+    return jsonify({"status": "ok", "transfers": len(transfers)}), 200
 
 
 def init_bot():
     """Инициализация бота"""
-    global application
+    global application, crypto_checker
 
     if not TELEGRAM_BOT_TOKEN:
         logger.error("❌ TELEGRAM_BOT_TOKEN не установлен!")
@@ -1445,9 +1399,22 @@ def init_bot():
     logger.info(f"📊 Порт: {PORT}")
     logger.info(f"🌍 Окружение: {ENVIRONMENT}")
     logger.info(f"👤 Администратор: {ADMIN_ID}")
+    logger.info(f"⚙️ Параллельных обновлений: до {MAX_CONCURRENT_UPDATES}")
+
+    # Крипточекер для автоматической проверки платежей
+    crypto_checker = SimpleCryptoChecker()
 
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Разные пользователи обрабатываются параллельно, один пользователь - по порядку
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
+    )
+
+    # Ограничение частоты запросов - до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, rate_limit_middleware), group=-1)
 
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start_command))
@@ -1460,34 +1427,91 @@ def init_bot():
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
 
+    # Периодическая проверка криптоплатежей
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            payment_scan_job,
+            interval=PAYMENT_SCAN_INTERVAL,
+            first=PAYMENT_SCAN_INTERVAL,
+            name="payment_scan",
+            job_kwargs={'jitter': PAYMENT_SCAN_JITTER, 'max_instances': 1, 'coalesce': True}
+        )
+        logger.info(f"⏱ Проверка платежей каждые {PAYMENT_SCAN_INTERVAL}с"
+                    f"{' (сверка, основной канал - push-уведомления)' if CHAIN_WEBHOOKS_ENABLED else ''}")
+        application.job_queue.run_repeating(
+            price_refresh_job,
+            interval=PRICE_CACHE_TTL,
+            first=0,
+            name="price_refresh"
+        )
+    else:
+        logger.warning("⚠️ JobQueue недоступна (нужен python-telegram-bot[job-queue]) - автоматическая проверка платежей отключена")
+
     return application
 
 
-async def setup_webhook():
-    """Настройка вебхука для production"""
-    await application.initialize()
+def install_stop_signals(stop_event):
+    """SIGTERM (Render при деплое) и SIGINT завершают ожидание: выполняется finally с сохранением состояний"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: обработчики сигналов в event loop не поддерживаются
+            pass
+
+
+async def run_webhook_server():
+    """Production режим: один event loop на все время работы бота
 
-    # delete old webhook if exists
-    await application.bot.delete_webhook(drop_pending_updates=True)
+    Loop владеет Application и обрабатывает очередь обновлений, Flask
+    (в отдельном потоке) только кладет входящие обновления в
+    application.update_queue и сразу отвечает Telegram.
+    """
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
 
+    await application.initialize()
     await application.start()
 
     await application.bot.set_webhook(
         url=f"{WEBHOOK_URL}/webhook",
         allowed_updates=Update.ALL_TYPES,
         drop_pending_updates=True,
+        secret_token=TELEGRAM_WEBHOOK_SECRET or None
     )
+    logger.info(f"✅ Вебхук установлен: {WEBHOOK_URL}/webhook")
 
-    # PTB’s internal web server starts automatically
-    await application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path="webhook",
-    )
+    # Flask обслуживает /webhook, /health, /stats и уведомления сетей
+    threading.Thread(
+        target=app.run,
+        kwargs={'host': '0.0.0.0', 'port': PORT, 'debug': False, 'use_reloader': False, 'threaded': True},
+        name="flask",
+        daemon=True
+    ).start()
+
+    logger.info("🤖 Бот запущен в режиме вебхуков!")
+
+    stop_event = asyncio.Event()
+    install_stop_signals(stop_event)
+    try:
+        await stop_event.wait()
+        logger.info("\n🛑 Получен сигнал остановки...")
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        logger.info("\n🛑 Получен сигнал остановки...")
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await crypto_checker.close()
+        user_states.stop()
+        shutdown_executor(wait=False)
+        logger.info("✅ Бот остановлен")
 
 
 async def run_polling():
     """Запуск polling режима"""
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
     try:
         # Удаляем вебхук если был установлен
         await application.bot.delete_webhook(drop_pending_updates=True)
@@ -1503,22 +1527,32 @@ async def run_polling():
     logger.info("🤖 Бот запущен в polling режиме!")
     logger.info("Нажмите Ctrl+C для остановки...")
 
-    # Ждем остановки
+    # Ждем остановки (Ctrl+C или SIGTERM)
+    stop_event = asyncio.Event()
+    install_stop_signals(stop_event)
     try:
-        # Бесконечный цикл
-        await asyncio.Event().wait()
+        await stop_event.wait()
+        logger.info("\n🛑 Получен сигнал остановки...")
     except (KeyboardInterrupt, SystemExit):
         logger.info("\n🛑 Получен сигнал остановки...")
     finally:
         await application.updater.stop()
         await application.stop()
         await application.shutdown()
+        await crypto_checker.close()
+        user_states.stop()
+        shutdown_executor(wait=False)
         logger.info("✅ Бот остановлен")
 
 
 def main():
     """Основная функция запуска"""
     init_bot()
+    stats_cache.start_background_refresh()
+    # Состояния диалогов: загрузка сохраненных и фоновая запись в SQLite
+    # Кнопки выбора валюты хранят данные в PayloadCache (только в памяти) и после
+    # перезапуска устаревают - такой диалог не восстанавливается
+    user_states.start_background_flush(drop_states={'waiting_crypto_selection'})
 
     if ENVIRONMENT == 'production':
         # Production режим (Render) - вебхуки
@@ -1528,11 +1562,10 @@ def main():
 
         logger.info("🌐 Запуск в production режиме (вебхуки)")
 
-        # Настраиваем вебхук при старте
-        asyncio.run(setup_webhook())
-
-        # Запускаем Flask
-        app.run(host='0.0.0.0', port=PORT, debug=False)
+        try:
+            asyncio.run(run_webhook_server())
+        except KeyboardInterrupt:
+            logger.info("\n🛑 Бот остановлен пользователем")
 
     else:
         # Local режим - polling
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Параллельная обработка обновлений Telegram с сохранением порядка по чату
+
+Обновления разных пользователей обрабатываются параллельно (не более
+max_concurrent_updates одновременно), обновления одного пользователя -
+строго по очереди, в порядке поступления: состояния диалога
+(user_states) рассчитаны на последовательную обработку.
+"""
+
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Глобальный лимит параллельности + последовательная обработка в пределах чата"""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # ключ чата -> [замок, число обновлений в работе или в ожидании]
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update):
+        """Ключ очереди: пользователь, иначе чат (None - без упорядочивания)"""
+        if not hasattr(update, 'effective_user'):
+            return None
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        """Выполнить обработку после обновлений того же чата
+
+        Вызывается базовым классом уже внутри общего семафора
+        (process_update переопределять нельзя), поэтому обновление,
+        ждущее своей очереди в чате, занимает один из слотов.
+        """
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
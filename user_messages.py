@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Тексты сообщений и клавиатуры меню бота
+
+Все создаются один раз при импорте: статические тексты и клавиатуры
+переиспользуются без изменений (объекты telegram неизменяемы), в
+шаблонах при показе подставляются только переменные поля
+(WELCOME_TEMPLATE.format(first_name=..., balance=...)).
+"""
+
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import SERVICES
+
+
+def _keyboard(*rows):
+    """Клавиатура из строк кнопок (текст, callback_data)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+
+@lru_cache(maxsize=None)
+def back_keyboard(back_action):
+    """Клавиатура с одной кнопкой назад (одна на каждое действие)"""
+    return _keyboard([("🔙 Назад", back_action)])
+
+
+# Главное меню
+
+WELCOME_TEMPLATE = """
+🤖 Добро пожаловать в SPACE PAY!
+
+👤 Пользователь: {first_name}
+💰 Баланс кошелька: {balance:.2f} USD
+
+Выберите действие:
+"""
+
+_MAIN_MENU_ROWS = (
+    [("🛒 Каталог услуг", "catalog")],
+    [("💰 Мой кошелек", "wallet")],
+    [("📋 Мои заказы", "orders")],
+    [("❓ Помощь", "help")]
+)
+MAIN_MENU_KEYBOARD = _keyboard(*_MAIN_MENU_ROWS)
+ADMIN_MAIN_MENU_KEYBOARD = _keyboard(*_MAIN_MENU_ROWS, [("🔧 Админ панель", "admin")])
+
+HELP_TEXT = """
+❓ Справка по использованию бота:
+
+📋 Основные команды:
+/start - Главное меню
+/menu - Каталог услуг
+/orders - Мои заказы
+/help - Эта справка
+/check_payment - Проверить платеж (админы)
+
+💳 Доступные услуги:
+• Подписки на сервисы
+• Переводы на карты
+• Другие услуги
+
+💰 Оплата:
+• Внутренний кошелек
+• Банковские карты
+• Криптовалюты
+
+📞 Поддержка:
+• Оператор: @myspacehelper
+"""
+
+
+# Каталог
+
+CATALOG_TEXT = """
+🛒 Каталог услуг
+
+Выберите категорию:
+"""
+
+CATALOG_KEYBOARD = _keyboard(
+    [("💳 Оплата зарубежной картой", "service_payment")],
+    # заменить на переводы --
+    [("💶 Перевод на счёт", "service_transfers")],
+    [("🔧 Другие сервисы", "service_other_services")],
+    [("🔙 Назад", "back_main")]
+)
+
+TRANSFERS_TEXT = """
+💳 Переводы
+
+Выберите тип перевода:
+"""
+
+TRANSFERS_KEYBOARD = _keyboard(
+    [("🇪🇺 Переводы в EC", "order_transfer_eu")],
+    [("🇺🇸 Переводы в США", "order_transfer_us")],
+    [("🔙 Назад", "back_catalog")]
+)
+
+OTHER_SERVICES_TEXT = """
+🔧 Оплата других сервисов
+
+Выберите услугу:
+"""
+
+OTHER_SERVICES_KEYBOARD = _keyboard(
+    [("🔧 Другие сервисы", "order_other_services")],
+    [("🔙 Назад", "back_catalog")]
+)
+
+PAYMENT_SERVICES_TEXT = """
+💳 Оплата любых платежей иностранной картой
+
+Выберите услугу:
+"""
+
+PAYMENT_SERVICES_KEYBOARD = _keyboard(
+    [("🤖 ChatGPT Plus", "order_gpt")],
+    [("🐦 X / Twitter", "order_twitter")],
+    [("🔍 Другое", "order_other_services")],
+    [("🔙 Назад", "back_catalog")]
+)
+
+
+def _service_order_text(service_info):
+    return f"""
+🛒 {service_info['name']}
+
+📝 Описание: {service_info['description']}
+{f"💰 Минимальная сумма: {service_info['min_amount']} USD" if service_info.get('min_amount') is not None else ""}
+{f"💸 Комиссия: {service_info['commission']*100}% USD" if service_info.get('min_amount') is not None else ""}
+
+Введите сумму заказа (в USD):
+"""
+
+
+# Описание услуги с запросом суммы - по одному тексту на услугу
+SERVICE_ORDER_TEXTS = {service_type: _service_order_text(info) for service_type, info in SERVICES.items()}
+
+
+# Кошелек
+
+WALLET_TEMPLATE = """
+💰 Мой кошелек
+
+💵 Баланс: {balance:.2f} USD
+
+Выберите действие:
+"""
+
+WALLET_KEYBOARD = _keyboard(
+    [("💳 Пополнить", "wallet_deposit")],
+    [("📊 История", "wallet_history")],
+    [("🔙 Назад", "back_main")]
+)
+
+DEPOSIT_OPTIONS_TEXT = """
+💳 Пополнение кошелька
+
+Выберите способ пополнения:
+"""
+
+DEPOSIT_OPTIONS_KEYBOARD = _keyboard(
+    [("💳 Перевод рублей на карту", "deposit_card")],
+    [("₿ Криптовалюта", "deposit_crypto")],
+    [("🔙 Назад", "wallet")]
+)
+
+
+# Админ панель
+
+ADMIN_PANEL_TEXT = """
+🔧 Админ панель
+
+Выберите действие:
+"""
+
+ADMIN_PANEL_KEYBOARD = _keyboard(
+    [("📋 Все заказы", "admin_orders")],
+    [("💰 Управление кошельками", "admin_wallets")],
+    [("📊 Статистика", "admin_stats")],
+    [("🔙 Назад", "back_main")]
+)